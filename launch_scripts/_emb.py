@@ -0,0 +1,19 @@
+def build_embedding_config(emb_arg):
+    """Build the embedding configuration from the embedding sizes given to the launch scripts.
+        emb_arg: [] or 0 for no embeddings (one hot encoding), [size] or size to sum all embeddings, or [root, form, ext, duration, metrical] sizes to concatenate them
+
+    Returns:
+        embedding_dim: dictionary of embedding sizes to pass to the model
+        emb_str: short description of the embeddings, used in the run names
+        use_embeddings: whether the model should use embeddings
+    """
+    if isinstance(emb_arg, int):
+        emb_arg = [emb_arg] if emb_arg > 0 else []
+    if emb_arg == []:
+        return {}, "noEmb", False
+    elif len(emb_arg) == 1:
+        return {"sum": emb_arg[0]}, f"sum{emb_arg[0]}", True
+    else:
+        embedding_dim = {"root": emb_arg[0], "form": emb_arg[1], "ext": emb_arg[2], "duration": emb_arg[3], "metrical" : emb_arg[4]} # sum roughtly 1/4 of the hidden size
+        emb_str = f"r{emb_arg[0]}f{emb_arg[1]}e{emb_arg[2]}d{emb_arg[3]}m{emb_arg[4]}"
+        return embedding_dim, emb_str, True
@@ -5,11 +5,13 @@ from pytorch_lightning import Trainer, seed_everything
 import torch
 import random
 import argparse
+import ast
 import warnings
 warnings.filterwarnings('ignore') # avoid printing the partitura warnings
 
 from musicparser.data_loading import TSDataModule
 from musicparser.models import ArcPredictionLightModel
+from _emb import build_embedding_config
 
 torch.multiprocessing.set_sharing_strategy('file_system')
 
@@ -54,28 +56,17 @@ def main():
     dropout = args.dropout
     wandb_log = args.wandb_log
     patience = args.patience
-    devices = eval(args.gpus)
+    devices = ast.literal_eval(args.gpus)
     use_pos_weight = args.pos_weight
     activation = args.activation
     data_augmentation = args.data_augmentation
     biaffine = args.biaffine
     encoder_type = args.encoder_type
     n_heads = args.n_heads
-    emb_arg = eval(args.embeddings)
-    if emb_arg == []:
-        use_embeddings = False
-        embedding_dim = {}
-        emb_str = "noEmb"
-    elif len(emb_arg) == 1:
-        embedding_dim = {"sum": emb_arg[0]}
-        use_embeddings = True
-        emb_str = f"sum{emb_arg[0]}"
-    else:
-        embedding_dim = {"root": emb_arg[0], "form": emb_arg[1], "ext": emb_arg[2], "duration": emb_arg[3], "metrical" : emb_arg[4]} # sum roughtly 1/4 of the hidden size
-        use_embeddings = True
-        emb_str = f"r{emb_arg[0]}f{emb_arg[0]}e{emb_arg[0]}d{emb_arg[3]}m{emb_arg[4]}"
+    emb_arg = ast.literal_eval(args.embeddings)
+    embedding_dim, emb_str, use_embeddings = build_embedding_config(emb_arg)
     rpr = args.pos_enc == "relative"
-    pretrain = eval(args.pretrain)
+    pretrain = ast.literal_eval(args.pretrain)
     loss_type = args.loss
     optimizer = args.optimizer
     warmup_steps = args.warmup_steps
@@ -112,7 +103,7 @@ def main():
         # callbacks=[checkpoint_callback, early_stop_callback, lr_monitor],
         callbacks = [lr_monitor],
         deterministic=True,
-        reload_dataloaders_every_n_epochs= 1 if data_augmentation=="online" else 0,
+        reload_dataloaders_every_n_epochs=0, # online augmentation is done in the dataset __getitem__, no need to rebuild the workers
         )
 
     trainer.fit(model, datamodule)
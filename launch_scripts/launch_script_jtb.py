@@ -4,6 +4,8 @@ from pytorch_lightning.callbacks.early_stopping import EarlyStopping
 from pytorch_lightning import Trainer, seed_everything
 import torch
 import argparse
+import math
+import ast
 import os
 import sys
 import inspect
@@ -16,10 +18,10 @@ sys.path.insert(0, parentdir)
 
 from musicparser.data_loading import JTBDataModule
 from musicparser.models import ArcPredictionLightModel
+from _emb import build_embedding_config
 
-torch.multiprocessing.set_sharing_strategy('file_system')
-
-# for repeatability
+# for repeatability, seeds python, numpy and torch (also in the dataloader workers).
+# The hash seed is fixed at interpreter startup, set PYTHONHASHSEED in the environment to fix it too
 seed_everything(0,workers=True)
 
 def main():
@@ -32,7 +34,11 @@ def main():
     parser.add_argument('--weight_decay', type=float, default=0.05)
     parser.add_argument("--activation", type=str, default="gelu")
     parser.add_argument("--wandb_log", action="store_true", help="Use wandb for logging.")
-    parser.add_argument("--num_workers", type=int, default=20)
+    parser.add_argument("--upload_model", action="store_true", help="Upload the model checkpoints to wandb.")
+    parser.add_argument("--num_workers", type=int, default=None, help="Defaults to 4 per GPU, capped by the number of CPUs.")
+    parser.add_argument("--n_jobs", type=int, default=20, help="Number of processes used to preprocess the dataset.")
+    parser.add_argument("--batch_size", type=int, default=1, help="Number of pieces per batch. Pieces of similar length are batched together.")
+    parser.add_argument("--accumulate_grad_batches", type=int, default=1, help="Number of batches to accumulate gradients over before each optimizer step.")
     parser.add_argument("--patience", type=int, default=50)
     parser.add_argument("--data_augmentation", type=str, default="preprocess", help="'preprocess', 'no', or 'online'")
     parser.add_argument("--biaffine", action="store_true", help="Use biaffine arc decoder.")
@@ -49,77 +55,102 @@ def main():
     parser.add_argument('--tree_type', type= str, default="open", help="'open' or 'complete'" )
     parser.add_argument('--max_epochs', type= int, default=60, help="max epochs for training")
     parser.add_argument('--no_validation', action="store_true", help="If true, no validation set is created.")
+    parser.add_argument('--deterministic', action="store_true", help="Use deterministic algorithms. Slower, but fully reproducible.")
+    parser.add_argument('--mp_sharing', type= str, default="file_descriptor", choices=["file_descriptor", "file_system"], help="Tensor sharing strategy between processes. Only the collated batches are shared with the forked workers. Use 'file_system' only if the file descriptor limit is too low, it leaks shared memory segments when a worker crashes." )
+    parser.add_argument('--sanity_steps', type= int, default=1, help="number of validation steps to run before training")
+    parser.add_argument('--verbose', action="store_true", help="Print the run parameters.")
+    parser.add_argument('--precision', type= str, default=None, help="'bf16', '16', or '32'. Defaults to bf16 mixed precision on GPUs that support it (no loss scaling needed), and to 32 otherwise, e.g. on CPU. An explicit bf16 falls back to 16 on GPUs without bf16 support." )
 
     args = parser.parse_args()
 
-    num_workers = args.num_workers
+    if args.mp_sharing == "file_system":
+        torch.multiprocessing.set_sharing_strategy('file_system')
+
+    batch_size = args.batch_size
+    accumulate_grad_batches = args.accumulate_grad_batches
     n_layers = args.n_layers
     n_hidden = args.n_hidden
     lr = args.lr
     weight_decay = args.weight_decay
     dropout = args.dropout
     wandb_log = args.wandb_log
+    upload_model = args.upload_model
     patience = args.patience
-    devices = eval(args.gpus)
+    devices = ast.literal_eval(args.gpus)
+    n_devices = devices if isinstance(devices, int) else len(devices) # devices can be a number of gpus or a list of gpu ids
+    num_workers = args.num_workers if args.num_workers is not None else min(os.cpu_count() or 1, 4 * max(n_devices, 1))
     use_pos_weight = args.pos_weight
     activation = args.activation
     data_augmentation = args.data_augmentation
     biaffine = args.biaffine
     encoder_type = args.encoder_type
     n_heads = args.n_heads
-    emb_arg = eval(args.embeddings)
-    if emb_arg == []:
-        use_embeddings = False
-        embedding_dim = {}
-        emb_str = "noEmb"
-    elif len(emb_arg) == 1:
-        embedding_dim = {"sum": emb_arg[0]}
-        use_embeddings = True
-        emb_str = f"sum{emb_arg[0]}"
-    else:
-        embedding_dim = {"root": emb_arg[0], "form": emb_arg[1], "ext": emb_arg[2], "duration": emb_arg[3], "metrical" : emb_arg[4]} # sum roughtly 1/4 of the hidden size
-        use_embeddings = True
-        emb_str = f"r{emb_arg[0]}f{emb_arg[0]}e{emb_arg[0]}d{emb_arg[3]}m{emb_arg[4]}"
+    emb_arg = ast.literal_eval(args.embeddings)
+    embedding_dim, emb_str, use_embeddings = build_embedding_config(emb_arg)
     rpr = args.pos_enc == "relative"
-    pretrain = eval(args.pretrain)
+    pretrain = ast.literal_eval(args.pretrain)
     loss_type = args.loss
     optimizer = args.optimizer
     warmup_steps = args.warmup_steps
     tree_type = args.tree_type
     max_epochs = args.max_epochs
+    sanity_steps = args.sanity_steps
+    verbose = args.verbose
     no_validation = args.no_validation
+    deterministic = args.deterministic
+    if not deterministic:
+        # let cuDNN pick the fastest kernels and use TF32 tensor cores for matmuls
+        torch.backends.cudnn.benchmark = True
+        torch.set_float32_matmul_precision("high")
+        torch.backends.cuda.matmul.allow_tf32 = True
+        torch.backends.cudnn.allow_tf32 = True
 
-    print("Starting a new run with the following parameters:")
-    print(args)
+    if verbose:
+        print("Starting a new run with the following parameters:")
+        print(args)
 
-    datamodule = JTBDataModule(batch_size=1, num_workers=num_workers, data_augmentation=data_augmentation, only_tree=not pretrain, tree_type=tree_type, no_validation = no_validation)
+    datamodule = JTBDataModule(batch_size=batch_size, num_workers=num_workers, n_jobs=args.n_jobs, data_augmentation=data_augmentation, only_tree=not pretrain, tree_type=tree_type, no_validation = no_validation)
     datamodule.setup()
     if use_pos_weight:
         pos_weight = int(datamodule.positive_weight)
-        print("Using pos_weight", pos_weight)
+        if verbose:
+            print("Using pos_weight", pos_weight)
     else:
         pos_weight = 1
+    # number of optimizer steps per epoch on each device, used by the lr scheduler
+    batches_per_device = math.ceil(math.ceil(len(datamodule.dataset_train) / batch_size) / max(n_devices, 1))
+    steps_per_epoch = math.ceil(batches_per_device / accumulate_grad_batches)
     input_dim = sum(embedding_dim.values()) if use_embeddings else 25
-    model = ArcPredictionLightModel(input_dim, n_hidden,pos_weight=pos_weight, dropout=dropout, lr=lr, weight_decay=weight_decay, n_layers=n_layers, activation=activation, use_embeddings=use_embeddings, embedding_dim=embedding_dim, biaffine=biaffine, encoder_type=encoder_type, n_heads=n_heads, data_type="chords", rpr = rpr, pretrain_mode= pretrain, loss_type = loss_type, optimizer = optimizer, warmup_steps= warmup_steps, max_epochs = max_epochs, len_train_dataloader= len(datamodule.dataset_train))
+    model = ArcPredictionLightModel(input_dim, n_hidden,pos_weight=pos_weight, dropout=dropout, lr=lr, weight_decay=weight_decay, n_layers=n_layers, activation=activation, use_embeddings=use_embeddings, embedding_dim=embedding_dim, biaffine=biaffine, encoder_type=encoder_type, n_heads=n_heads, data_type="chords", rpr = rpr, pretrain_mode= pretrain, loss_type = loss_type, optimizer = optimizer, warmup_steps= warmup_steps, max_epochs = max_epochs, len_train_dataloader= steps_per_epoch)
 
     if wandb_log:
         name = f"{encoder_type}-{n_layers}-{n_hidden}-lr={lr}-wd={weight_decay}-dr={dropout}-act={activation}-emb={emb_str}-aug={data_augmentation}-biaf={biaffine}-heads={n_heads}-rpr={rpr}-loss={loss_type}-PW={use_pos_weight}-opt={optimizer}-warmup={warmup_steps}-T={tree_type}"        
-        wandb_logger = WandbLogger(log_model = True, project="Parsing JTB", name= name )
+        wandb_logger = WandbLogger(log_model = upload_model, project="Parsing JTB", name= name )
     else:
         wandb_logger = True
 
-    checkpoint_callback = ModelCheckpoint(save_top_k=1, monitor="val_head_accuracy", mode="max")
+    checkpoint_callback = ModelCheckpoint(save_top_k=1, monitor="val_head_accuracy", mode="max", save_weights_only=True)
     early_stop_callback = EarlyStopping(monitor="val_head_accuracy", min_delta=0.00, patience=patience, verbose=True, mode="max")
     lr_monitor = LearningRateMonitor(logging_interval='step')
+    # resolve the precision only after the datamodule is built, since querying the GPU initializes CUDA
+    if args.precision is None:
+        precision = "bf16" if torch.cuda.is_available() and torch.cuda.is_bf16_supported() else 32
+    else:
+        precision = int(args.precision) if args.precision.isdigit() else args.precision
+    if precision == "bf16" and torch.cuda.is_available() and not torch.cuda.is_bf16_supported():
+        precision = 16 # pre-Ampere GPUs
     
     trainer = Trainer(
         max_epochs=max_epochs, accelerator="auto", devices= devices, #strategy="ddp",
-        num_sanity_val_steps=1,
+        precision=precision,
+        replace_sampler_ddp=False, # the dataloaders split the pieces among the devices themselves, see get_dataloader
+        accumulate_grad_batches=accumulate_grad_batches, # Lightning skips the ddp gradient sync on the accumulating batches
+        num_sanity_val_steps=sanity_steps,
         logger=wandb_logger,
         # callbacks=[checkpoint_callback, early_stop_callback, lr_monitor],
         callbacks=[lr_monitor],
-        deterministic=True,
-        reload_dataloaders_every_n_epochs= 1 if data_augmentation=="online" else 0,
+        deterministic=deterministic,
+        reload_dataloaders_every_n_epochs=0, # online augmentation is done in the dataset __getitem__, no need to rebuild the workers
         log_every_n_steps=10
         )
 
@@ -5,12 +5,14 @@ from pytorch_lightning import Trainer, seed_everything
 import torch
 import random
 import argparse
+import ast
 import warnings
 import wandb
 warnings.filterwarnings('ignore') # avoid printing the partitura warnings
 
 from musicparser.data_loading import JTBDataModule
 from musicparser.models import ArcPredictionLightModel
+from _emb import build_embedding_config
 
 torch.multiprocessing.set_sharing_strategy('file_system')
 
@@ -37,19 +39,8 @@ def main(config):
     loss_type = config["loss_type"]
     optimizer = config["optimizer"]
     warmup_steps = config["warmup_steps"]
-    emb_arg = eval(config["embeddings"])
-    if emb_arg == []:
-        use_embeddings = False
-        embedding_dim = {}
-        emb_str = "noEmb"
-    elif len(emb_arg) == 1:
-        embedding_dim = {"sum": emb_arg[0]}
-        use_embeddings = True
-        emb_str = f"sum{emb_arg[0]}"
-    else:
-        embedding_dim = {"root": emb_arg[0], "form": emb_arg[1], "ext": emb_arg[2], "duration": emb_arg[3], "metrical" : emb_arg[4]} # sum roughtly 1/4 of the hidden size
-        use_embeddings = True
-        emb_str = f"r{emb_arg[0]}f{emb_arg[0]}e{emb_arg[0]}d{emb_arg[3]}m{emb_arg[4]}"
+    emb_arg = ast.literal_eval(config["embeddings"])
+    embedding_dim, emb_str, use_embeddings = build_embedding_config(emb_arg)
     
     rpr = "relative"
     pretrain = False
@@ -83,7 +74,7 @@ def main(config):
         logger=wandb_logger,
         callbacks=[lr_monitor],
         deterministic=True,
-        reload_dataloaders_every_n_epochs= 1 if data_augmentation=="online" else 0,
+        reload_dataloaders_every_n_epochs=0, # online augmentation is done in the dataset __getitem__, no need to rebuild the workers
         # log_every_n_steps=10
         )
 
@@ -1,29 +1,30 @@
 from pytorch_lightning.loggers import WandbLogger
 from pytorch_lightning.callbacks import ModelCheckpoint, LearningRateMonitor
 from pytorch_lightning.callbacks.early_stopping import EarlyStopping
-from pytorch_lightning import Trainer
+from pytorch_lightning import Trainer, seed_everything
 import torch
-import random
 import argparse
+import gc
+import math
+import os
+import ast
 import warnings
 import wandb
 warnings.filterwarnings('ignore') # avoid printing the partitura warnings
 
 from musicparser.data_loading import TSDataModule
 from musicparser.models import ArcPredictionLightModel
+from _emb import build_embedding_config
 
-torch.multiprocessing.set_sharing_strategy('file_system')
-
-# for repeatability
-torch.manual_seed(0)
-random.seed(0)
-torch.use_deterministic_algorithms(True)
-
-wandb_run = wandb.init(group = "Sweep-TS", job_type="TS")
-# Config parameters are automatically set by W&B sweep agent
-config = wandb.config
+# for repeatability, seeds python, numpy and torch (also in the dataloader workers).
+# The hash seed is fixed at interpreter startup, set PYTHONHASHSEED in the environment to fix it too
+seed_everything(0,workers=True)
 
 def main(config):
+    # only the collated batches are shared with the forked workers. Use file_system only if the file descriptor limit is too low,
+    # it leaks shared memory segments when a worker crashes
+    if config.get("mp_sharing", "file_descriptor") == "file_system":
+        torch.multiprocessing.set_sharing_strategy('file_system')
     # set parameters from config
     n_layers = config["n_layers"]
     n_hidden = config["n_hidden"]
@@ -38,64 +39,89 @@ def main(config):
     loss_type = config["loss_type"]
     optimizer = config["optimizer"]
     warmup_steps = config["warmup_steps"]
-    emb_arg = eval(config["embeddings"])
-    if emb_arg == []:
-        use_embeddings = False
-        embedding_dim = {}
-        emb_str = "noEmb"
-    elif len(emb_arg) == 1:
-        embedding_dim = {"sum": emb_arg[0]}
-        use_embeddings = True
-        emb_str = f"sum{emb_arg[0]}"
-    else:
-        embedding_dim = {"root": emb_arg[0], "form": emb_arg[1], "ext": emb_arg[2], "duration": emb_arg[3], "metrical" : emb_arg[4]} # sum roughtly 1/4 of the hidden size
-        use_embeddings = True
-        emb_str = f"r{emb_arg[0]}f{emb_arg[0]}e{emb_arg[0]}d{emb_arg[3]}m{emb_arg[4]}"
+    batch_size = config.get("batch_size", 1)
+    accumulate_grad_batches = config.get("accumulate_grad_batches", 1)
+    emb_arg = ast.literal_eval(config["embeddings"])
+    embedding_dim, emb_str, use_embeddings = build_embedding_config(emb_arg)
  
     rpr = "relative"
     pretrain = False
-    num_workers = 20
-    devices = [0]
+    # run length and resources can be set by the sweep, e.g. to run shorter trials with hyperband
+    devices = config.get("devices", [0])
+    n_devices = devices if isinstance(devices, int) else len(devices) # devices can be a number of gpus or a list of gpu ids
+    num_workers = config.get("num_workers", min(os.cpu_count() or 1, 4 * max(n_devices, 1)))
     wandb_log = True
-    patience = 30
+    patience = config.get("patience", 30)
     use_pos_weight = True
-    data_augmentation = "preprocess"
-    max_epochs = 60
+    data_augmentation = config.get("data_augmentation", "preprocess")
+    max_epochs = config.get("max_epochs", 60)
+    deterministic = config.get("deterministic", False)
+    if deterministic:
+        torch.use_deterministic_algorithms(True)
+    else:
+        # let cuDNN pick the fastest kernels and use TF32 tensor cores for matmuls
+        torch.backends.cudnn.benchmark = True
+        torch.set_float32_matmul_precision("high")
+        torch.backends.cuda.matmul.allow_tf32 = True
+        torch.backends.cudnn.allow_tf32 = True
 
 
-    datamodule = TSDataModule(batch_size=1, num_workers=num_workers, will_use_embeddings=use_embeddings, data_augmentation=data_augmentation)
+    datamodule = TSDataModule(batch_size=batch_size, num_workers=num_workers, n_jobs=config.get("n_jobs", 20), will_use_embeddings=use_embeddings, data_augmentation=data_augmentation)
     datamodule.setup()
     if use_pos_weight:
         pos_weight = int(datamodule.positive_weight)
-        print("Using pos_weight", pos_weight)
+        if config.get("verbose", False):
+            print("Using pos_weight", pos_weight)
     else:
         pos_weight = 1
+    # number of optimizer steps per epoch on each device, used by the lr scheduler
+    batches_per_device = math.ceil(math.ceil(len(datamodule.dataset_train) / batch_size) / max(n_devices, 1))
+    steps_per_epoch = math.ceil(batches_per_device / accumulate_grad_batches)
     input_dim = sum(embedding_dim.values()) if use_embeddings else 25
-    model = ArcPredictionLightModel(input_dim, n_hidden,pos_weight=pos_weight, dropout=dropout, lr=lr, weight_decay=weight_decay, n_layers=n_layers, activation=activation, use_embeddings=use_embeddings, embedding_dim=embedding_dim, biaffine=biaffine, encoder_type=encoder_type, n_heads=n_heads, data_type="notes", rpr = rpr, pretrain_mode= pretrain, loss_type = loss_type, optimizer=optimizer, warmup_steps=warmup_steps, max_epochs = max_epochs, len_train_dataloader= len(datamodule.dataset_train) )
+    model = ArcPredictionLightModel(input_dim, n_hidden,pos_weight=pos_weight, dropout=dropout, lr=lr, weight_decay=weight_decay, n_layers=n_layers, activation=activation, use_embeddings=use_embeddings, embedding_dim=embedding_dim, biaffine=biaffine, encoder_type=encoder_type, n_heads=n_heads, data_type="notes", rpr = rpr, pretrain_mode= pretrain, loss_type = loss_type, optimizer=optimizer, warmup_steps=warmup_steps, max_epochs = max_epochs, len_train_dataloader= steps_per_epoch)
 
     if wandb_log:
         name = ""        
-        wandb_logger = WandbLogger(log_model = True, project="Parsing TS", name= name )
+        wandb_logger = WandbLogger(log_model = False, project="Parsing TS", name= name ) # uploading checkpoints stalls every sweep trial
     else:
         wandb_logger = True
 
-    checkpoint_callback = ModelCheckpoint(save_top_k=1, monitor="val_head_accuracy_postp", mode="max")
+    checkpoint_callback = ModelCheckpoint(save_top_k=1, monitor="val_head_accuracy_postp", mode="max", save_weights_only=True, save_on_train_epoch_end=False)
     early_stop_callback = EarlyStopping(monitor="val_head_accuracy_postp", min_delta=0.00, patience=patience, verbose=True, mode="max")
     lr_monitor = LearningRateMonitor(logging_interval='step')
+    # resolve the precision only after the datamodule is built, since querying the GPU initializes CUDA
+    # bf16 needs no loss scaling, but keep full precision on CPU, where it would change the numerics of the whole run
+    default_precision = "bf16" if torch.cuda.is_available() and torch.cuda.is_bf16_supported() else 32
+    precision = config.get("precision", default_precision)
+    if precision == "bf16" and torch.cuda.is_available() and not torch.cuda.is_bf16_supported():
+        precision = 16 # pre-Ampere GPUs
     trainer = Trainer(
         max_epochs=max_epochs, accelerator="auto", devices= devices, #strategy="ddp",
-        num_sanity_val_steps=1,
+        precision=precision,
+        replace_sampler_ddp=False, # the dataloaders split the pieces among the devices themselves, see get_dataloader
+        accumulate_grad_batches=accumulate_grad_batches, # Lightning skips the ddp gradient sync on the accumulating batches
+        num_sanity_val_steps=0, # a sanity check per trial is too expensive in a sweep
+        enable_progress_bar=False,
+        enable_model_summary=False,
         logger=wandb_logger,
         callbacks=[checkpoint_callback, early_stop_callback,lr_monitor],
-        deterministic=True,
-        reload_dataloaders_every_n_epochs= 1 if data_augmentation=="online" else 0,
+        deterministic=deterministic,
+        reload_dataloaders_every_n_epochs=0, # online augmentation is done in the dataset __getitem__, no need to rebuild the workers
         )
 
     trainer.fit(model, datamodule)
     trainer.test(model, datamodule,ckpt_path=checkpoint_callback.best_model_path)
+    # drop the references so that the next trial starts from a clean heap. We don't call torch.cuda.empty_cache(),
+    # the caching allocator keeps its memory pool warm for the next trial
+    del model, trainer, datamodule
+    gc.collect()
 
 
 
 if __name__ == "__main__":
-    print(f'Starting a run with {config}')
+    # init wandb only when run as a script, so that the module can be imported without a network handshake
+    wandb_run = wandb.init(group = "Sweep-TS", job_type="TS")
+    # Config parameters are automatically set by W&B sweep agent
+    config = wandb.config
+    # the run configuration is already recorded by wandb
     main(config)
\ No newline at end of file
@@ -1,7 +1,8 @@
 from pathlib import Path
 import pandas as pd
 import xml.etree.ElementTree as ET
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import Dataset, DataLoader, Sampler, Subset, ConcatDataset, DistributedSampler
+from torch.nn.utils.rnn import pad_sequence
 import numpy as np
 import partitura as pt
 from pytorch_lightning import LightningDataModule
@@ -9,9 +10,11 @@ import torch
 from sklearn.model_selection import train_test_split, StratifiedKFold
 import torch.nn.functional as F
 from collections import defaultdict
+from functools import cached_property, lru_cache, partial
 from joblib import Parallel, delayed
 from tqdm  import tqdm
 import json
+import math
 import re
 
 MINIMUM_OCTAVE = 4
@@ -103,6 +106,7 @@ class TSDataModule(LightningDataModule):
         data_augmentation="no",
         loo_index = None,
         no_validation=False,
+        n_jobs=None,
     ):
         super(TSDataModule, self).__init__()
         if data_augmentation not in ["no", "online", "preprocess"]:
@@ -119,12 +123,16 @@ class TSDataModule(LightningDataModule):
             Path("data/gttm"),
             will_use_embeddings=will_use_embeddings,
             data_augmentation=data_augmentation,
-            n_jobs=num_workers,
+            n_jobs=num_workers if n_jobs is None else n_jobs, # processes used to load the scores
         )
-        self.positive_weight = self.dataset.get_positive_weight()
         # check for already setup
         self.is_setup = False
 
+    @cached_property
+    def positive_weight(self):
+        # computed only once, and only if needed
+        return self.dataset.get_positive_weight()
+
     def prepare_data(self):
         pass
 
@@ -176,27 +184,131 @@ class TSDataModule(LightningDataModule):
         self.is_setup = True
 
     def train_dataloader(self):
-        return DataLoader(
-            self.dataset_train,
-            batch_size=self.batch_size,
-            num_workers=self.num_workers,
-            shuffle=True,
-        )
+        return get_dataloader(self.dataset_train, self.batch_size, self.num_workers, shuffle=True)
 
     def val_dataloader(self):
-        return DataLoader(
-            self.dataset_val, batch_size=self.batch_size, num_workers=self.num_workers
-        )
+        return get_dataloader(self.dataset_val, self.batch_size, self.num_workers)
 
     def test_dataloader(self):
-        return DataLoader(
-            self.dataset_test, batch_size=self.batch_size, num_workers=self.num_workers
-        )
+        return get_dataloader(self.dataset_test, self.batch_size, self.num_workers)
 
     # def predict_dataloader(self):
     #     return DataLoader(self.dataset_predict, batch_size=self.batch_size, num_workers=self.num_workers)
 
 
+def collate_sequences(batch, has_rests=True):
+    """Pad a list of pieces (note_seq, truth_mask, pot_arcs, head_seq) to the longest piece of the batch.
+    Returns the padded tensors, the rest mask over the head sequences (rests have head -1, always False if has_rests is False, e.g., for chords),
+    plus a tensor of shape (batch_size, 2) with the number of notes and of potential arcs of each piece, that the model uses to remove the padding.
+    """
+    note_seqs, truth_masks, pot_arcs, head_seqs = zip(*batch)
+    pot_arcs = [p_arc.reshape(-1, 2) for p_arc in pot_arcs] # pieces without trees have an empty 1d tensor
+    lengths = torch.tensor([[len(n_feat), p_arc.shape[0]] for n_feat, p_arc in zip(note_seqs, pot_arcs)])
+    head_seqs = pad_sequence(head_seqs, batch_first=True, padding_value=-1)
+    is_rest = head_seqs == -1 if has_rests else torch.zeros_like(head_seqs, dtype=torch.bool)
+    return (
+        pad_sequence(note_seqs, batch_first=True),
+        pad_sequence(truth_masks, batch_first=True),
+        pad_sequence(pot_arcs, batch_first=True),
+        head_seqs,
+        is_rest,
+        lengths,
+    )
+
+
+class BucketBatchSampler(Sampler):
+    """Batch sampler that groups pieces of similar length, to minimize the padding in each batch.
+    The order of the batches, and of the pieces with the same length, is shuffled at every epoch (see set_epoch).
+    With distributed training, all the replicas draw the same shuffle and each one takes its share of the batches,
+    like torch.utils.data.DistributedSampler. Lightning can't inject its own distributed sampler in this batch sampler,
+    so the Trainer must be built with replace_sampler_ddp=False when it is used on more than one device.
+    """
+
+    def __init__(self, lengths, batch_size, num_replicas=None, rank=None, seed=0):
+        distributed = torch.distributed.is_available() and torch.distributed.is_initialized()
+        if num_replicas is None:
+            num_replicas = torch.distributed.get_world_size() if distributed else 1
+        if rank is None:
+            rank = torch.distributed.get_rank() if distributed else 0
+        self.lengths = np.array(lengths)
+        self.batch_size = batch_size
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.epoch = 0
+        self.num_batches = math.ceil(len(self.lengths) / batch_size)
+        # every replica must run the same number of steps
+        self.num_batches_per_replica = math.ceil(self.num_batches / num_replicas)
+
+    def set_epoch(self, epoch):
+        # called by Lightning at the start of every epoch
+        self.epoch = epoch
+
+    def __iter__(self):
+        # a dedicated generator leaves the global RNG untouched, and gives the same shuffle on all the replicas
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)
+        # random noise smaller than 1 only shuffles pieces with the same length
+        noise = torch.rand(len(self.lengths), generator=generator).numpy()
+        order = np.argsort(self.lengths + noise)
+        batches = [order[i:i + self.batch_size].tolist() for i in range(0, len(order), self.batch_size)]
+        batch_order = torch.randperm(len(batches), generator=generator).tolist()
+        # repeat some batches so that the batches are evenly divisible among the replicas
+        total = self.num_batches_per_replica * self.num_replicas
+        batch_order = (batch_order * math.ceil(total / len(batch_order)))[:total]
+        for i in batch_order[self.rank:total:self.num_replicas]:
+            yield batches[i]
+
+    def __len__(self):
+        return self.num_batches_per_replica
+
+
+def get_piece_lengths(dataset):
+    """Number of notes (or chords) of each piece of the dataset, read from the dataset metadata without loading the pieces."""
+    if isinstance(dataset, Subset):
+        lengths = get_piece_lengths(dataset.dataset)
+        return [lengths[i] for i in dataset.indices]
+    if isinstance(dataset, ConcatDataset):
+        return [length for d in dataset.datasets for length in get_piece_lengths(d)]
+    return dataset.lengths
+
+
+def get_dataloader(dataset, batch_size, num_workers, shuffle=False, has_rests=True):
+    """Build a DataLoader that pads the pieces of each batch (see collate_sequences). When shuffling with batch_size > 1, pieces of similar length are batched together.
+    Workers are kept alive between epochs, and batches are pinned in memory for asynchronous transfer to the GPU.
+    Workers are forked from the main process, so they share the dataset tensors instead of receiving a pickled copy of the whole dataset,
+    which forkserver or spawn would send with one file descriptor per tensor.
+    With distributed training the pieces are split among the devices by the loader itself, since the launchers
+    turn off Lightning's sampler replacement when batching with the BucketBatchSampler.
+    """
+    worker_kwargs = {"persistent_workers": True, "prefetch_factor": 4} if num_workers > 0 else {}
+    collate_fn = partial(collate_sequences, has_rests=has_rests)
+    if shuffle and batch_size > 1:
+        lengths = get_piece_lengths(dataset)
+        return DataLoader(
+            dataset,
+            batch_sampler=BucketBatchSampler(lengths, batch_size),
+            num_workers=num_workers,
+            collate_fn=collate_fn,
+            pin_memory=True,
+            **worker_kwargs,
+        )
+    if torch.distributed.is_available() and torch.distributed.is_initialized():
+        # Lightning calls set_epoch on this sampler at every epoch
+        sampler_kwargs = {"sampler": DistributedSampler(dataset, shuffle=shuffle)}
+    else:
+        sampler_kwargs = {"shuffle": shuffle}
+    return DataLoader(
+        dataset,
+        batch_size=batch_size,
+        num_workers=num_workers,
+        collate_fn=collate_fn,
+        pin_memory=True,
+        **sampler_kwargs,
+        **worker_kwargs,
+    )
+
+
 class TSDataset(Dataset):
     """Dataset for the TS trees."""
 
@@ -231,6 +343,7 @@ class TSDataset(Dataset):
         self.truth_masks = dict_of_lists["truth_mask"]
         self.time_signatures = dict_of_lists["time_signature"]
         self.head_seqs = dict_of_lists["head_seq"]
+        self.lengths = [len(n_feat) for n_feat in self.note_features]
 
     def _process_score(self, title, score_file, ts_xml_file):
         try:
@@ -339,6 +452,7 @@ class TSDatasetAugmented(Dataset):
                 self.aug_truth_masks.append(t_mask)
                 self.aug_head_seqs.append(h_seq)
                 assert torch.all(n_feat_transp >= 0)
+        self.lengths = [len(n_feat) for n_feat in self.aug_note_features]
 
     def __len__(self):
         return len(self.aug_truth_masks)
@@ -581,6 +695,12 @@ def get_metrical_one_hot(metrical):
     return F.one_hot(metrical.to(torch.int64), num_classes=6)
 
 
+@lru_cache(maxsize=None)
+def get_tanh_durations(device):
+    """Table of the squashed duration values, built once per device instead of being copied to the device at every forward."""
+    return torch.tanh(torch.tensor(DURATIONS, device=device))
+
+
 def get_feats_one_hot(n_feats):
     pitch = n_feats[:, 0]
     is_rest = n_feats[:, 1]
@@ -596,7 +716,7 @@ def get_feats_one_hot(n_feats):
     octave_oh = octave_oh[:, MINIMUM_OCTAVE:MAXIMUM_OCTAVE]
     # compute one hot encoding for duration
     # duration_oh = get_duration_one_hot(duration)
-    duration = torch.tanh(torch.tensor(DURATIONS).to(duration.device)[duration])
+    duration = get_tanh_durations(duration.device)[duration]
     # compute one hot encoding for metrical position
     metrical_oh = get_metrical_one_hot(metrical)
     return torch.hstack(
@@ -616,6 +736,9 @@ def data_preparation(n_feats, will_use_embeddings=False):
 
 
 def online_data_augmentation(n_feats):
+    # work on a copy, the workers are persistent so the stored features must not drift across epochs.
+    # The torch RNG of each worker is seeded by the DataLoader, so workers draw different transpositions
+    n_feats = n_feats.clone()
     random_transp_int = int(torch.randint(low=-12, high=13, size=(1,))[0])
     transpose_mask = (
         n_feats[:, 1] == 0
@@ -808,6 +931,7 @@ class JTBDataModule(LightningDataModule):
         data_augmentation="no",
         loo_index = None,
         no_validation=False,
+        n_jobs=None,
     ):
         super(JTBDataModule, self).__init__()
         if data_augmentation not in ["no", "online", "preprocess"]:
@@ -820,12 +944,16 @@ class JTBDataModule(LightningDataModule):
         self.batch_size = batch_size
         self.num_workers = num_workers
         # instatiate dataset
-        self.dataset = JTBDataset("data/jazz_tb/treebank.json", data_augmentation=data_augmentation, only_tree=only_tree, tree_type=tree_type,n_jobs=num_workers)
-        self.positive_weight = self.dataset.get_positive_weight()
+        self.dataset = JTBDataset("data/jazz_tb/treebank.json", data_augmentation=data_augmentation, only_tree=only_tree, tree_type=tree_type,n_jobs=num_workers if n_jobs is None else n_jobs)
         # check for already setup
         self.is_setup = False
         
 
+    @cached_property
+    def positive_weight(self):
+        # computed only once, and only if needed
+        return self.dataset.get_positive_weight()
+
     def prepare_data(self):
         pass
 
@@ -883,33 +1011,19 @@ class JTBDataModule(LightningDataModule):
         self.is_setup = True
 
     def pre_train_dataloader(self):
-        return DataLoader(
-            self.dataset_pretrain,
-            batch_size=self.batch_size,
-            num_workers=self.num_workers,
-            shuffle=True,
-        )
+        return get_dataloader(self.dataset_pretrain, self.batch_size, self.num_workers, shuffle=True, has_rests=False)
 
     def train_dataloader(self):
-        return DataLoader(
-            self.dataset_train,
-            batch_size=self.batch_size,
-            num_workers=self.num_workers,
-            shuffle=True,
-        )
+        return get_dataloader(self.dataset_train, self.batch_size, self.num_workers, shuffle=True, has_rests=False)
 
     def val_dataloader(self):
-        return DataLoader(
-            self.dataset_val, batch_size=self.batch_size, num_workers=self.num_workers
-        )
+        return get_dataloader(self.dataset_val, self.batch_size, self.num_workers, has_rests=False)
 
     def test_dataloader(self):
-        return DataLoader(
-            self.dataset_test, batch_size=self.batch_size, num_workers=self.num_workers
-        )
+        return get_dataloader(self.dataset_test, self.batch_size, self.num_workers, has_rests=False)
 
     # def predict_dataloader(self):
-    #     return DataLoader(self.dataset_predict, batch_size=self.batch_size, num_workers=self.num_workers)
+    #     return DataLoader(self.dataset_predict, batch_size=self.batch_size, num_workers=self.num_workers, has_rests=False)
 
 
 class JTBDataset(Dataset):
@@ -1004,6 +1118,7 @@ class JTBDataset(Dataset):
                 self.time_signatures.append((ts_dict["numerator"],ts_dict["denominator"]))
                 self.titles.append(dict_data[i]["title"])
                 self.head_seqs.append(head_seq)
+        self.lengths = [len(chord_feat) for chord_feat in self.chords_features]
         print(f"Done loading data. {len(dict_data)-len(self.chords_features)} out of {len(dict_data)} pieces were discarded because of errors.")
 
 
@@ -1073,6 +1188,7 @@ class JTBDatasetAugmented(Dataset):
                 self.aug_pot_arcs.append(p_arc)
                 self.aug_truth_masks.append(t_mask)
                 self.aug_head_seqs.append(h_seq)
+        self.lengths = [len(chord_feat) for chord_feat in self.aug_note_features]
 
     def __len__(self):
         return len(self.aug_truth_masks)
@@ -1086,6 +1202,8 @@ class JTBDatasetAugmented(Dataset):
         )
 
 def online_chord_augmentation(chord_feat):
+    # work on a copy, the workers are persistent so the stored features must not drift across epochs
+    chord_feat = chord_feat.clone()
     random_transp_int = int(torch.randint(low=0, high=11, size=(1,))[0])
     chord_feat[:, 0] = np.remainder(chord_feat[:, 0] + random_transp_int,12)
     return chord_feat
@@ -7,6 +7,8 @@ import torch_geometric as pyg
 from torch.nn import CrossEntropyLoss
 from torchmetrics.classification import BinaryF1Score, BinaryAccuracy, MulticlassAccuracy
 import numpy as np
+import inspect
+from functools import lru_cache
 
 from musicparser.metrics import CTreeSpanSimilarity, VariableMulticlassAccuracy, ArcsAccuracy, CTreeNodeSimilarity
 from musicparser.rpr import TransformerEncoderLayerRPR, TransformerEncoderRPR, DummyDecoder
@@ -65,49 +67,95 @@ class ArcPredictionLightModel(LightningModule):
         self.len_train_dataloader = len_train_dataloader
         self.max_epochs = max_epochs
         self.loss_type = loss_type
-        if loss_type == 'bce':
-            self.train_loss = torch.nn.BCEWithLogitsLoss(pos_weight= torch.tensor([pos_weight]))
-            self.val_loss = torch.nn.BCEWithLogitsLoss(pos_weight= torch.tensor([pos_weight]))
-        elif loss_type == 'ce':
+        # single on-device copy of the positive weight, shared by the train and val bce losses
+        self.register_buffer("pos_weight", torch.tensor([pos_weight], dtype=torch.float32))
+        if loss_type == 'ce':
             self.train_loss = torch.nn.CrossEntropyLoss(ignore_index=-1) 
             self.val_loss = torch.nn.CrossEntropyLoss(ignore_index=-1) 
         elif loss_type == 'both':
-            self.train_loss_bce = torch.nn.BCEWithLogitsLoss(pos_weight= torch.tensor([pos_weight]))
-            self.val_loss_bce = torch.nn.BCEWithLogitsLoss(pos_weight= torch.tensor([pos_weight]))
             self.train_loss_ce = torch.nn.CrossEntropyLoss(ignore_index=-1) 
             self.val_loss_ce = torch.nn.CrossEntropyLoss(ignore_index=-1) 
-        else:
+        elif loss_type != 'bce': # the bce loss is computed with F.binary_cross_entropy_with_logits
             raise ValueError(f"loss_type {loss_type} not supported")
-        self.val_f1score = BinaryF1Score()
-        self.val_f1score_postp = BinaryF1Score()
-        self.val_head_accuracy = VariableMulticlassAccuracy()
-        self.val_head_accuracy_postp = VariableMulticlassAccuracy()
-        self.val_arc_accuracy_postp = ArcsAccuracy()
-        self.val_span_similarity = CTreeSpanSimilarity()
-        self.val_node_similarity = CTreeNodeSimilarity()
-        self.test_f1score = BinaryF1Score()
-        self.test_f1score_postp = BinaryF1Score()
-        self.test_head_accuracy = VariableMulticlassAccuracy(ignore_index=-1)
-        self.test_head_accuracy_postp = VariableMulticlassAccuracy(ignore_index=-1)
-        self.test_arc_accuracy_postp = ArcsAccuracy()
-        self.test_span_similarity = CTreeSpanSimilarity()
-        self.test_node_similarity = CTreeNodeSimilarity()
+        # the evaluation metrics are computed on cpu. They are kept in a plain dict, not registered as submodules,
+        # so that Lightning never moves them to the gpu (they are also not part of the state_dict)
+        self._cpu_metrics = {
+            "val_f1score": BinaryF1Score(),
+            "val_f1score_postp": BinaryF1Score(),
+            "val_head_accuracy": VariableMulticlassAccuracy(),
+            "val_head_accuracy_postp": VariableMulticlassAccuracy(),
+            "val_arc_accuracy_postp": ArcsAccuracy(),
+            "val_span_similarity": CTreeSpanSimilarity(),
+            "val_node_similarity": CTreeNodeSimilarity(),
+            "test_f1score": BinaryF1Score(),
+            "test_f1score_postp": BinaryF1Score(),
+            "test_head_accuracy": VariableMulticlassAccuracy(ignore_index=-1),
+            "test_head_accuracy_postp": VariableMulticlassAccuracy(ignore_index=-1),
+            "test_arc_accuracy_postp": ArcsAccuracy(),
+            "test_span_similarity": CTreeSpanSimilarity(),
+            "test_node_similarity": CTreeNodeSimilarity(),
+        }
         self.pretrain_mode = pretrain_mode
+        self._truth_ctree_cache = {}
         if pretrain_mode:
-            # self.pre_train_loss = nn.ModuleDict({"root": CrossEntropyLoss(), "form": CrossEntropyLoss(), "ext": CrossEntropyLoss(), "dur": CrossEntropyLoss(), "met": CrossEntropyLoss()})
-            self.pre_train_loss = CrossEntropyLoss()
-            self.pre_train_accuracy = nn.ModuleDict({"root": MulticlassAccuracy(12), "form": MulticlassAccuracy(len(CHORD_FORM)), "ext": MulticlassAccuracy(len(CHORD_EXTENSION)), "dur": MulticlassAccuracy(len(JTB_DURATION)), "met": MulticlassAccuracy(METRICAL_LEVELS)})
-            # self.pre_val_loss = nn.ModuleDict({"root": CrossEntropyLoss(), "form": CrossEntropyLoss(), "ext": CrossEntropyLoss(), "dur": CrossEntropyLoss(), "met": CrossEntropyLoss()})
-            self.pre_val_loss = CrossEntropyLoss()
-            self.pre_val_accuracy = nn.ModuleDict({"root": MulticlassAccuracy(12), "form": MulticlassAccuracy(len(CHORD_FORM)), "ext": MulticlassAccuracy(len(CHORD_EXTENSION)), "dur": MulticlassAccuracy(len(JTB_DURATION)), "met": MulticlassAccuracy(METRICAL_LEVELS)})
+            # the chord label heads (root, form, ext, dur, met) are padded to the largest number of classes to compute the loss together
+            head_num_classes = [12, len(CHORD_FORM), len(CHORD_EXTENSION), len(JTB_DURATION), METRICAL_LEVELS]
+            self.pretrain_num_classes = max(head_num_classes)
+            # but each head has its own accuracy, since class k of different heads are different labels
+            self.pre_train_accuracy = nn.ModuleList([MulticlassAccuracy(n) for n in head_num_classes])
+            self.pre_val_accuracy = nn.ModuleList([MulticlassAccuracy(n) for n in head_num_classes])
+
+    def cpu_metric(self, name):
+        """Return the evaluation metric called name, see self._cpu_metrics."""
+        return self._cpu_metrics[name]
+
+    def reset_cpu_metrics(self, stage):
+        # Lightning does not see these metrics, so their accumulated state is reset here
+        for name, metric in self._cpu_metrics.items():
+            if name.startswith(stage):
+                metric.reset()
+
+    def on_validation_epoch_start(self):
+        self.reset_cpu_metrics("val")
+
+    def on_test_epoch_start(self):
+        self.reset_cpu_metrics("test")
+
+    def get_truth_ctree(self, truth_arc):
+        """Constituent tree of the truth arcs. The truth trees are the same at every epoch, so they are cached by their arcs,
+        which stays valid for any dataloader and any order of the pieces."""
+        truth_arc = truth_arc.cpu()
+        key = tuple(map(tuple, truth_arc.tolist()))
+        truth_ctree = self._truth_ctree_cache.get(key)
+        if truth_ctree is None:
+            truth_ctree = dtree2unlabeled_ctree(truth_arc)
+            self._truth_ctree_cache[key] = truth_ctree
+        return truth_ctree
+
+    def unbatch(self, batch):
+        """Split a padded batch (see data_loading.collate_sequences) into the list of its pieces, removing the padding."""
+        note_seqs, truth_arcs_masks, pot_arcs, head_seqs, is_rest, lengths = batch
+        return [(note_seqs[i,:num_notes], truth_arcs_masks[i,:num_pot_arcs], pot_arcs[i,:num_pot_arcs], head_seqs[i,:num_notes+1], is_rest[i,:num_notes+1]) for i, (num_notes, num_pot_arcs) in enumerate(lengths.tolist())]
 
     def training_step(self, batch, batch_idx):
-        note_seq, truth_arcs_mask, pot_arcs, head_seqs = batch
-        note_seq, truth_arcs_mask, pot_arcs, head_seqs = note_seq[0], truth_arcs_mask[0], pot_arcs[0], head_seqs[0]
+        pieces = self.unbatch(batch)
+        if not self.pretrain_mode: # normal mode, predict arcs
+            loss = sum(self.training_piece_step(*piece) for piece in pieces) / len(pieces)
+            self.log("train_loss", loss.detach(), prog_bar=True, on_step=True, on_epoch=True, batch_size=len(pieces))
+            return loss
+        else: # pretrain mode, predict chord labels
+            losses, accuracies = zip(*[self.training_piece_step(*piece) for piece in pieces])
+            loss = sum(losses) / len(pieces)
+            accuracy = sum(accuracies) / len(pieces)
+            self.log("pre_train_loss", loss.detach(), prog_bar=True, on_step=True, on_epoch=True, batch_size=len(pieces))
+            self.log("pre_train_acc", accuracy.detach(), prog_bar=True, on_step=True, on_epoch=True, batch_size=len(pieces))
+            return loss
+
+    def training_piece_step(self, note_seq, truth_arcs_mask, pot_arcs, head_seqs, is_rest):
         if not self.pretrain_mode: # normal mode, predict arcs
             arc_pred_mask_logits = self.module(note_seq, pot_arcs)
             if self.loss_type == 'bce':
-                loss = self.train_loss(arc_pred_mask_logits.float(), truth_arcs_mask.float())
+                loss = F.binary_cross_entropy_with_logits(arc_pred_mask_logits.float(), truth_arcs_mask.float(), pos_weight=self.pos_weight)
             elif self.loss_type == 'ce':
                 num_notes = len(note_seq)
                 # add the extra line and row for the root node
@@ -117,90 +165,94 @@ class ArcPredictionLightModel(LightningModule):
                 num_notes = len(note_seq)
                 # add the extra line and row for the root node
                 adj_pred_logits_root = self.compute_adj_logits_root(pot_arcs, arc_pred_mask_logits, num_notes)
-                loss_bce = self.train_loss_bce(arc_pred_mask_logits.float(), truth_arcs_mask.float())
+                loss_bce = F.binary_cross_entropy_with_logits(arc_pred_mask_logits.float(), truth_arcs_mask.float(), pos_weight=self.pos_weight)
                 loss_ce = self.train_loss_ce(adj_pred_logits_root.T,head_seqs.long())
                 loss = loss_bce + loss_ce
-            self.log("train_loss", loss.item(), prog_bar=True, on_step=True, on_epoch=True, batch_size=1)
             return loss
         else: # pretrain mode, predict chord labels
             # shift input sequence to the right, and shorten prediction by one, to compare with prediction at next position
             input = note_seq[:-1,:]
             expected = note_seq[1:,:]
             # get mask for input sequence
-            mask = generate_square_subsequent_mask(len(expected)).to(self.device)
+            mask = generate_square_subsequent_mask(len(expected), device=self.device)
             # predict chord labels
             pred_logits = self.module(input,None,mask=mask)
-            loss = 0
-            accuracy = 0
-            for i,key in enumerate(pred_logits.keys()):
-                loss+= self.pre_train_loss(pred_logits[key], expected[:,i].long())
-                # self.log(f"train_loss_{key}", loss.item(), prog_bar=True, on_step=True, on_epoch=True, batch_size=1)
-                accuracy += self.pre_train_accuracy[key](pred_logits[key], expected[:,i].long())
-                # self.log(f"train_acc_{key}", acc.item(), prog_bar=True, on_step=True, on_epoch=True, batch_size=1)
-            # loss = loss/len(pred_logits.keys())
-            accuracy = accuracy/len(pred_logits.keys())
-            self.log("pre_train_loss", loss.item(), prog_bar=True, on_step=True, on_epoch=True, batch_size=1)
-            self.log("pre_train_acc", accuracy.item(), prog_bar=True, on_step=True, on_epoch=True, batch_size=1)
-            return loss
+            logits, targets = self.concat_pretrain_heads(pred_logits, expected)
+            # the mean over all heads times the number of heads is the sum of the per-head means
+            loss = F.cross_entropy(logits, targets) * len(pred_logits)
+            accuracy = self.pretrain_accuracy(self.pre_train_accuracy, pred_logits, expected)
+            return loss, accuracy
+
+
+    def pretrain_accuracy(self, accuracies, pred_logits, expected):
+        """Mean of the accuracies of the chord label heads, each head is evaluated with its own metric."""
+        return sum(accuracy(logits, expected[:, i].long()) for i, (accuracy, logits) in enumerate(zip(accuracies, pred_logits))) / len(pred_logits)
+
+    def concat_pretrain_heads(self, pred_logits, expected):
+        """Concatenate the logits and targets of all chord label heads, to compute loss and accuracy with a single call.
+        The logits of each head are padded with -inf to a common number of classes."""
+        logits = torch.cat([F.pad(logits, (0, self.pretrain_num_classes - logits.shape[1]), value=float("-inf")) for logits in pred_logits])
+        # targets of each head are in the corresponding column of expected, concatenate them in the same order as the logits
+        targets = expected[:, :len(pred_logits)].T.reshape(-1).long()
+        return logits, targets
 
 
     def validation_step(self, batch, batch_idx):
-        note_seq, truth_arcs_mask, pot_arcs, head_seqs = batch
-        note_seq, truth_arcs_mask, pot_arcs, head_seqs = note_seq[0], truth_arcs_mask[0], pot_arcs[0], head_seqs[0]
+        for piece in self.unbatch(batch):
+            self.validation_piece_step(*piece)
+
+    def validation_piece_step(self, note_seq, truth_arcs_mask, pot_arcs, head_seqs, is_rest):
         if not self.pretrain_mode: # normal mode, predict arcs
             num_notes = len(note_seq)
             # predict arcs
             arc_pred_mask_logits = self.module(note_seq, pot_arcs)
-            arc_pred__mask_normalized = torch.sigmoid(arc_pred_mask_logits)
-            pred_arc = pot_arcs[torch.round(arc_pred__mask_normalized).squeeze().bool()]
+            pred_arc = pot_arcs[arc_pred_mask_logits > 0] # same as rounding the sigmoid
             truth_arc = pot_arcs[truth_arcs_mask.bool()]
-            # predict rest mask
-            if self.data_type == "notes":
-                # find rests
-                is_rest = head_seqs == -1
-            else:    
-                is_rest = torch.zeros_like(head_seqs).bool() # for chords there are no rests
             # compute adjency matrix of logits predictions
             adj_pred_logits_root = self.compute_adj_logits_root(pot_arcs, arc_pred_mask_logits, num_notes)
             # compute loss
             if self.loss_type == 'bce':
-                val_loss = self.val_loss(arc_pred_mask_logits.float(), truth_arcs_mask.float())
+                val_loss = F.binary_cross_entropy_with_logits(arc_pred_mask_logits.float(), truth_arcs_mask.float(), pos_weight=self.pos_weight)
             elif self.loss_type == 'ce':
                 val_loss = self.val_loss(adj_pred_logits_root.T,head_seqs.long())
             elif self.loss_type == 'both':
-                val_loss_bce = self.val_loss_bce(arc_pred_mask_logits.float(), truth_arcs_mask.float())
+                val_loss_bce = F.binary_cross_entropy_with_logits(arc_pred_mask_logits.float(), truth_arcs_mask.float(), pos_weight=self.pos_weight)
                 val_loss_ce = self.val_loss_ce(adj_pred_logits_root.T,head_seqs.long())
                 val_loss = val_loss_bce + val_loss_ce
-            self.log("val_loss", val_loss.item(), on_epoch=True, batch_size=1)
+            self.log("val_loss", val_loss.detach(), on_epoch=True, batch_size=1)
             # compute binary F1 score and accuracy
             # adj_pred = self.pred_dlist2adj(pred_arc,num_notes)
-            adj_pred = (adj_pred_logits_root > 0).long().cpu()
-            adj_target = self.compute_adj_root(truth_arc,num_notes).long().cpu()
-            val_fscore = self.val_f1score.cpu()(adj_pred.flatten(), adj_target.flatten())
-            self.log("val_fscore", val_fscore.item(), prog_bar=False, batch_size=1)
-            val_head_accuracy = self.val_head_accuracy(torch.argmax(adj_pred_logits_root, dim =0), head_seqs.long())
-            self.log("val_head_accuracy", val_head_accuracy.item(), prog_bar=True, batch_size=1)
+            # move the logits to cpu once, all the metrics are computed there
+            adj_pred_logits_root_cpu = adj_pred_logits_root.detach().cpu()
+            adj_pred = (adj_pred_logits_root_cpu > 0).long().flatten()
+            head_seqs_pred = torch.argmax(adj_pred_logits_root_cpu, dim =0)
+            adj_target = self.compute_adj_root(truth_arc,num_notes).long().cpu().flatten()
+            head_seqs_cpu = head_seqs.long().cpu()
+            val_fscore = self.cpu_metric("val_f1score")(adj_pred, adj_target)
+            self.log("val_fscore", val_fscore.detach(), prog_bar=False, batch_size=1)
+            val_head_accuracy = self.cpu_metric("val_head_accuracy")(head_seqs_pred, head_seqs_cpu)
+            self.log("val_head_accuracy", val_head_accuracy.detach(), prog_bar=True, batch_size=1)
             # postprocess
             adj_pred_postp, pred_arc_postp, head_seqs_postp = self.postprocess(adj_pred_logits_root, num_notes, is_rest)
             # compute postprocessed F1 score
-            val_fscore_postp = self.val_f1score_postp.cpu()(adj_pred_postp.flatten().cpu(), adj_target.flatten())
-            self.log("val_fscore_postp", val_fscore_postp.item(), prog_bar=False, batch_size=1)
+            val_fscore_postp = self.cpu_metric("val_f1score_postp")(adj_pred_postp.flatten().cpu(), adj_target)
+            self.log("val_fscore_postp", val_fscore_postp.detach(), prog_bar=False, batch_size=1)
             # compute head accuracy
             # head_seqs_postp = get_head_seq(pred_arc_postp, num_notes, check_unique_root=False) 
-            val_head_accuracy_postp = self.val_head_accuracy_postp.cpu()(head_seqs_postp.long(), head_seqs.long().cpu())
-            self.log("val_head_accuracy_postp", val_head_accuracy_postp.item(), prog_bar=True, batch_size=1)
+            val_head_accuracy_postp = self.cpu_metric("val_head_accuracy_postp")(head_seqs_postp.long(), head_seqs_cpu)
+            self.log("val_head_accuracy_postp", val_head_accuracy_postp.detach(), prog_bar=True, batch_size=1)
             # compute arcs accuracy
             rootless_pred_arc_postp = pred_arc_postp[pred_arc_postp[:,0]!=0]
             rootless_truth_arc = truth_arc[truth_arc[:,0]!=0]
-            val_arc_accuracy_postp = self.val_arc_accuracy_postp.cpu()(rootless_pred_arc_postp.cpu(), rootless_truth_arc.cpu())
-            self.log("val_arc_accuracy_postp", val_arc_accuracy_postp.item(), prog_bar=True, batch_size=1)
+            val_arc_accuracy_postp = self.cpu_metric("val_arc_accuracy_postp")(rootless_pred_arc_postp.cpu(), rootless_truth_arc.cpu())
+            self.log("val_arc_accuracy_postp", val_arc_accuracy_postp.detach(), prog_bar=True, batch_size=1)
             # compute c_tree span and node similarity
             pred_ctree = dtree2unlabeled_ctree(pred_arc_postp.cpu())
-            truth_ctree = dtree2unlabeled_ctree(truth_arc.cpu())
-            val_span_sim = self.val_span_similarity.cpu()(pred_ctree, truth_ctree)
-            self.log("val_ctree_sim", val_span_sim.item(), prog_bar=True, batch_size=1)
-            val_node_sim = self.val_node_similarity.cpu()(pred_ctree, truth_ctree)
-            self.log("val_node_sim", val_node_sim.item(), prog_bar=True, batch_size=1)
+            truth_ctree = self.get_truth_ctree(truth_arc)
+            val_span_sim = self.cpu_metric("val_span_similarity")(pred_ctree, truth_ctree)
+            self.log("val_ctree_sim", val_span_sim.detach(), prog_bar=True, batch_size=1)
+            val_node_sim = self.cpu_metric("val_node_similarity")(pred_ctree, truth_ctree)
+            self.log("val_node_sim", val_node_sim.detach(), prog_bar=True, batch_size=1)
             # log other useful stuff for debugging
             # if not isinstance(self.logger, CSVLogger):
             #     self.logger.log_text(key="head_seqs", columns = ["head_seqs","head_seqs_postp","truth_head_seqs" ], data= [[str(torch.argmax(adj_pred_logits_root, dim =0).tolist()), str(head_seqs_postp.tolist()),str(head_seqs.long().tolist())]])
@@ -210,138 +262,138 @@ class ArcPredictionLightModel(LightningModule):
             input = note_seq[:-1,:]
             expected = note_seq[1:,:]
             # get mask for input sequence
-            mask = generate_square_subsequent_mask(len(expected)).to(self.device)
+            mask = generate_square_subsequent_mask(len(expected), device=self.device)
             # predict chord labels
             pred_logits = self.module(input,None,mask=mask)
-            loss = 0
-            accuracy = 0
-            for i,key in enumerate(pred_logits.keys()):
-                loss+= self.pre_train_loss(pred_logits[key], expected[:,i].long())
-                # self.log(f"train_loss_{key}", loss.item(), prog_bar=True, on_step=True, on_epoch=True, batch_size=1)
-                accuracy += self.pre_train_accuracy[key](pred_logits[key], expected[:,i].long())
-                # self.log(f"train_acc_{key}", acc.item(), prog_bar=True, on_step=True, on_epoch=True, batch_size=1)
-            # loss = loss/len(pred_logits.keys())
-            accuracy = accuracy/len(pred_logits.keys())
-            self.log("pre_val_loss", loss.item(), prog_bar=True, on_epoch=True, batch_size=1)
-            self.log("pre_val_acc", accuracy.item(), prog_bar=True, on_epoch=True, batch_size=1)
+            logits, targets = self.concat_pretrain_heads(pred_logits, expected)
+            # the mean over all heads times the number of heads is the sum of the per-head means
+            loss = F.cross_entropy(logits, targets) * len(pred_logits)
+            accuracy = self.pretrain_accuracy(self.pre_val_accuracy, pred_logits, expected)
+            self.log("pre_val_loss", loss.detach(), prog_bar=True, on_epoch=True, batch_size=1)
+            self.log("pre_val_acc", accuracy.detach(), prog_bar=True, on_epoch=True, batch_size=1)
 
     
     def test_step(self, batch, batch_idx):
-        note_seq, truth_arcs_mask, pot_arcs, head_seqs = batch
-        note_seq, truth_arcs_mask, pot_arcs, head_seqs = note_seq[0], truth_arcs_mask[0], pot_arcs[0], head_seqs[0]
+        for piece in self.unbatch(batch):
+            self.test_piece_step(*piece)
+
+    def test_piece_step(self, note_seq, truth_arcs_mask, pot_arcs, head_seqs, is_rest):
         num_notes = len(note_seq)
-        # predict rest mask
-        if self.data_type == "notes":
-            # find rests
-            is_rest = head_seqs == -1
-        else:    
-            is_rest = torch.zeros_like(head_seqs).bool() # for chords there are no rests
         # predict arcs
         arc_pred_mask_logits = self.module(note_seq, pot_arcs)
-        arc_pred__mask_normalized = torch.sigmoid(arc_pred_mask_logits)
-        pred_arc = pot_arcs[torch.round(arc_pred__mask_normalized).squeeze().bool()]
+        pred_arc = pot_arcs[arc_pred_mask_logits > 0] # same as rounding the sigmoid
         truth_arc = pot_arcs[truth_arcs_mask.bool()]
         adj_pred_logits_root = self.compute_adj_logits_root(pot_arcs, arc_pred_mask_logits, num_notes)
         # compute binary F1 score and accuracy
-        adj_pred = (adj_pred_logits_root > 0).long().cpu()
-        adj_target = self.compute_adj_root(truth_arc,num_notes).long().cpu()
-        test_fscore = self.test_f1score.cpu()(adj_pred.flatten(), adj_target.flatten())
-        self.log("test_fscore", test_fscore.item(), prog_bar=False, batch_size=1)
-        test_head_accuracy = self.test_head_accuracy(torch.argmax(adj_pred_logits_root, dim =0), head_seqs.long())
-        self.log("test_head_accuracy", test_head_accuracy.item(), prog_bar=True, batch_size=1)
+        # move the logits to cpu once, all the metrics are computed there
+        adj_pred_logits_root_cpu = adj_pred_logits_root.detach().cpu()
+        adj_pred = (adj_pred_logits_root_cpu > 0).long().flatten()
+        head_seqs_pred = torch.argmax(adj_pred_logits_root_cpu, dim =0)
+        adj_target = self.compute_adj_root(truth_arc,num_notes).long().cpu().flatten()
+        head_seqs_cpu = head_seqs.long().cpu()
+        test_fscore = self.cpu_metric("test_f1score")(adj_pred, adj_target)
+        self.log("test_fscore", test_fscore.detach(), prog_bar=False, batch_size=1)
+        test_head_accuracy = self.cpu_metric("test_head_accuracy")(head_seqs_pred, head_seqs_cpu)
+        self.log("test_head_accuracy", test_head_accuracy.detach(), prog_bar=True, batch_size=1)
         # postprocess
         adj_pred_postp, pred_arc_postp, head_seqs_postp = self.postprocess(adj_pred_logits_root, num_notes, is_rest)
         # compute postprocessed F1 score
-        test_fscore_postp = self.test_f1score_postp.cpu()(adj_pred_postp.flatten().cpu(), adj_target.flatten())
-        self.log("test_fscore_postp", test_fscore_postp.item(), prog_bar=False, batch_size=1)
+        test_fscore_postp = self.cpu_metric("test_f1score_postp")(adj_pred_postp.flatten().cpu(), adj_target)
+        self.log("test_fscore_postp", test_fscore_postp.detach(), prog_bar=False, batch_size=1)
         # compute head accuracy
         # head_seqs_postp = get_head_seq(pred_arc_postp, num_notes,check_unique_root=False) 
-        test_head_accuracy_postp = self.test_head_accuracy_postp.cpu()(head_seqs_postp.long(), head_seqs.long().cpu())
-        self.log("test_head_accuracy_postp", test_head_accuracy_postp.item(), prog_bar=True, batch_size=1)
+        test_head_accuracy_postp = self.cpu_metric("test_head_accuracy_postp")(head_seqs_postp.long(), head_seqs_cpu)
+        self.log("test_head_accuracy_postp", test_head_accuracy_postp.detach(), prog_bar=True, batch_size=1)
         # compute arcs accuracy
         rootless_pred_arc_postp = pred_arc_postp[pred_arc_postp[:,0]!=0]
         rootless_truth_arc = truth_arc[truth_arc[:,0]!=0]
-        test_arc_accuracy_postp = self.test_arc_accuracy_postp.cpu()(rootless_pred_arc_postp.cpu(), rootless_truth_arc.cpu())
-        self.log("test_arc_accuracy_postp", test_arc_accuracy_postp.item(), prog_bar=True, batch_size=1)
+        test_arc_accuracy_postp = self.cpu_metric("test_arc_accuracy_postp")(rootless_pred_arc_postp.cpu(), rootless_truth_arc.cpu())
+        self.log("test_arc_accuracy_postp", test_arc_accuracy_postp.detach(), prog_bar=True, batch_size=1)
         # compute c_tree span and node similarity
         pred_ctree = dtree2unlabeled_ctree(pred_arc_postp.cpu())
         truth_ctree = dtree2unlabeled_ctree(truth_arc.cpu())
-        test_span_sim = self.test_span_similarity.cpu()(pred_ctree, truth_ctree)
-        self.log("test_ctree_sim", test_span_sim.item(), prog_bar=True, batch_size=1)
-        test_node_sim = self.test_node_similarity.cpu()(pred_ctree, truth_ctree)
-        self.log("test_node_sim", test_node_sim.item(), prog_bar=True, batch_size=1)
+        test_span_sim = self.cpu_metric("test_span_similarity")(pred_ctree, truth_ctree)
+        self.log("test_ctree_sim", test_span_sim.detach(), prog_bar=True, batch_size=1)
+        test_node_sim = self.cpu_metric("test_node_similarity")(pred_ctree, truth_ctree)
+        self.log("test_node_sim", test_node_sim.detach(), prog_bar=True, batch_size=1)
         if not isinstance(self.logger, CSVLogger):
-            self.logger.log_text(key="test_head_seqs", columns = ["head_seqs","head_seqs_postp","truth_head_seqs" ], data= [[str(torch.argmax(adj_pred_logits_root, dim =0).tolist()), str(head_seqs_postp.tolist()),str(head_seqs.long().tolist())]])
+            self.logger.log_text(key="test_head_seqs", columns = ["head_seqs","head_seqs_postp","truth_head_seqs" ], data= [[str(head_seqs_pred.tolist()), str(head_seqs_postp.tolist()),str(head_seqs_cpu.tolist())]])
             self.logger.log_text(key="test_ctrees", columns = ["pred_ctree","truth_ctree"], data= [[str(pred_ctree.unlabeled_repr()),str(truth_ctree.unlabeled_repr())]])
 
     
     def predict_step(self, batch, batch_idx):
-        note_seq, truth_arcs_mask, pot_arcs, head_seqs = batch
-        note_seq, truth_arcs_mask, pot_arcs, head_seqs = note_seq[0], truth_arcs_mask[0], pot_arcs[0], head_seqs[0]
+        """Returns the prediction of the piece for batches of one piece, as before batching was introduced, and the list of the predictions of each piece otherwise."""
+        predictions = [self.predict_piece_step(*piece) for piece in self.unbatch(batch)]
+        return predictions[0] if len(predictions) == 1 else predictions
+
+    def predict_piece_step(self, note_seq, truth_arcs_mask, pot_arcs, head_seqs, is_rest):
         num_notes = len(note_seq)
         # predict arcs
         arc_pred_mask_logits = self.module(note_seq, pot_arcs)
-        arc_pred__mask_normalized = torch.sigmoid(arc_pred_mask_logits)
-        pred_arc = pot_arcs[torch.round(arc_pred__mask_normalized).squeeze().bool()]
+        pred_arc = pot_arcs[arc_pred_mask_logits > 0] # same as rounding the sigmoid
         truth_arc = pot_arcs[truth_arcs_mask.bool()]
         adj_pred_logits_root = self.compute_adj_logits_root(pot_arcs, arc_pred_mask_logits, num_notes)
         # compute binary F1 score and accuracy
-        adj_pred = (adj_pred_logits_root > 0).long().cpu()
-        adj_target = self.compute_adj_root(truth_arc,num_notes).long().cpu()
-        test_fscore = self.test_f1score.cpu()(adj_pred.flatten(), adj_target.flatten())
-        print("test_fscore", test_fscore.item())
-        test_head_accuracy = self.test_head_accuracy(torch.argmax(adj_pred_logits_root, dim =0), head_seqs.long())
-        print("test_head_accuracy", test_head_accuracy.item())
+        # move the logits to cpu once, all the metrics are computed there
+        adj_pred_logits_root_cpu = adj_pred_logits_root.detach().cpu()
+        adj_pred = (adj_pred_logits_root_cpu > 0).long().flatten()
+        head_seqs_pred = torch.argmax(adj_pred_logits_root_cpu, dim =0)
+        adj_target = self.compute_adj_root(truth_arc,num_notes).long().cpu().flatten()
+        head_seqs_cpu = head_seqs.long().cpu()
+        test_fscore = self.cpu_metric("test_f1score")(adj_pred, adj_target)
+        test_head_accuracy = self.cpu_metric("test_head_accuracy")(head_seqs_pred, head_seqs_cpu)
         # postprocess
-        adj_pred_postp, pred_arc_postp, head_seqs_postp = self.postprocess(adj_pred_logits_root, num_notes)
+        adj_pred_postp, pred_arc_postp, head_seqs_postp = self.postprocess(adj_pred_logits_root, num_notes, is_rest)
         # compute postprocessed F1 score
-        test_fscore_postp = self.test_f1score_postp.cpu()(adj_pred_postp.flatten().cpu(), adj_target.flatten())
-        print("test_fscore_postp", test_fscore_postp.item())
+        test_fscore_postp = self.cpu_metric("test_f1score_postp")(adj_pred_postp.flatten().cpu(), adj_target)
         # compute head accuracy
         # head_seqs_postp = get_head_seq(pred_arc_postp, num_notes,check_unique_root=False) 
-        test_head_accuracy_postp = self.test_head_accuracy_postp.cpu()(head_seqs_postp.long(), head_seqs.long().cpu())
-        print("test_head_accuracy_postp", test_head_accuracy_postp.item())
+        test_head_accuracy_postp = self.cpu_metric("test_head_accuracy_postp")(head_seqs_postp.long(), head_seqs_cpu)
         # compute arcs accuracy
         rootless_pred_arc_postp = pred_arc_postp[pred_arc_postp[:,0]!=0]
         rootless_truth_arc = truth_arc[truth_arc[:,0]!=0]
-        test_arc_accuracy_postp = self.test_arc_accuracy_postp.cpu()(rootless_pred_arc_postp.cpu(), rootless_truth_arc.cpu())
-        print("test_arc_accuracy_postp", test_arc_accuracy_postp.item())
+        test_arc_accuracy_postp = self.cpu_metric("test_arc_accuracy_postp")(rootless_pred_arc_postp.cpu(), rootless_truth_arc.cpu())
         # compute c_tree span and node similarity
         pred_ctree = dtree2unlabeled_ctree(pred_arc_postp.cpu())
         truth_ctree = dtree2unlabeled_ctree(truth_arc.cpu())
-        test_span_sim = self.test_span_similarity.cpu()(pred_ctree, truth_ctree)
-        print("test_ctree_sim", test_span_sim.item())
-        test_node_sim = self.test_node_similarity.cpu()(pred_ctree, truth_ctree)
-        print("test_node_sim", test_node_sim.item())
-        return {"pot_arcs": pot_arcs, "arc_pred__mask_normalized" : arc_pred__mask_normalized,"head_seq_truth": head_seqs.long().cpu().tolist(),"head_seq_postp" : head_seqs_postp.cpu().tolist(), "head_seq" : torch.argmax(adj_pred_logits_root, dim =0).cpu().tolist() , "pred_arc" : pred_arc.cpu().tolist() , "pred_arc_postp": pred_arc_postp.cpu().tolist(), "truth_arc": truth_arc.cpu().tolist(), "pred_ctree": pred_ctree, "truth_ctree": truth_ctree}
+        test_span_sim = self.cpu_metric("test_span_similarity")(pred_ctree, truth_ctree)
+        test_node_sim = self.cpu_metric("test_node_similarity")(pred_ctree, truth_ctree)
+        return {"pot_arcs": pot_arcs, "arc_pred__mask_normalized" : torch.sigmoid(arc_pred_mask_logits),"head_seq_truth": head_seqs_cpu.tolist(),"head_seq_postp" : head_seqs_postp.cpu().tolist(), "head_seq" : head_seqs_pred.tolist() , "pred_arc" : pred_arc.cpu().tolist() , "pred_arc_postp": pred_arc_postp.cpu().tolist(), "truth_arc": truth_arc.cpu().tolist(), "pred_ctree": pred_ctree, "truth_ctree": truth_ctree,
+                # metrics of the piece, returned instead of printed
+                "test_fscore": test_fscore, "test_head_accuracy": test_head_accuracy, "test_fscore_postp": test_fscore_postp, "test_head_accuracy_postp": test_head_accuracy_postp,
+                "test_arc_accuracy_postp": test_arc_accuracy_postp, "test_ctree_sim": test_span_sim, "test_node_sim": test_node_sim}
 
         
     
     def compute_adj_logits_root(self,pot_arcs, arc_pred_mask_logits, num_notes):
-        # adj_pred_logits_root = to_dense(torch.sparse_coo_tensor(pot_arcs.T, arc_pred_mask_logits, (num_notes+1, num_notes+1)),fill_value=float("-inf")).to(arc_pred_mask_logits.device)
-        adj_pred_logits_root = torch.sparse_coo_tensor(pot_arcs.T, arc_pred_mask_logits, (num_notes+1, num_notes+1),device=arc_pred_mask_logits.device).to_dense()
-        adj_pred_logits_root[adj_pred_logits_root==0] = float("-inf") #hoping there are no other elements that are exactly 0
+        # scatter the logits in a dense matrix, the elements that are not potential arcs are -inf
+        adj_pred_logits_root = torch.full((num_notes+1, num_notes+1), float("-inf"), device=arc_pred_mask_logits.device, dtype=arc_pred_mask_logits.dtype)
+        adj_pred_logits_root.index_put_((pot_arcs[:,0], pot_arcs[:,1]), arc_pred_mask_logits)
         return adj_pred_logits_root
     
     def compute_adj_root(self,arcs, num_notes):
-        return torch.sparse_coo_tensor(arcs.T, torch.ones((len(arcs))), (num_notes+1, num_notes+1),device=arcs.device).to_dense()
+        adj_root = torch.zeros((num_notes+1, num_notes+1), device=arcs.device)
+        adj_root[arcs[:,0], arcs[:,1]] = 1
+        return adj_root
 
  
 
     def postprocess(self, arc_pred_logits_root, num_notes, is_rest, alg = "eisner"):
-        adj_pred_log_probs_root = arc_pred_logits_root[:,~is_rest][~is_rest,:]
+        # cast to float32, logits can be in half precision when training with mixed precision, and numpy does not support bf16
+        # single copy to cpu, the postprocessing algorithms run on numpy
+        adj_pred_log_probs_root = arc_pred_logits_root[:,~is_rest][~is_rest,:].float().detach().cpu().numpy()
         
         if alg == "chuliu_edmonds": #transpose to have an adjency matrix with edges pointing toward the parent node and 
-            head_seq = chuliu_edmonds_one_root(adj_pred_log_probs_root.cpu().numpy().T)
+            head_seq = chuliu_edmonds_one_root(adj_pred_log_probs_root.T)
         elif alg == "eisner":
-            head_seq = eisner(adj_pred_log_probs_root.cpu().numpy())
+            head_seq = eisner(adj_pred_log_probs_root)
             if np.sum(head_seq == 0) >1: 
                 ###############!!!!!!!!!!!!!!!!!!!!!!!!!! This is a bad trick to avoid the postprocessing having only arcs to 0. 
                 # TODO: Solve this problem in the postp algo
                 adj_pred_log_probs_root[0,:] = float("-inf")
                 adj_pred_log_probs_root[0][0] = 0
                 adj_pred_log_probs_root[0][-1] = 0
-                head_seq = eisner(adj_pred_log_probs_root.cpu().numpy())
+                head_seq = eisner(adj_pred_log_probs_root)
         # elif alg == "eisner_fast":
         #     head_seq = eisner_fast(torch.unsqueeze(adj_pred_log_probs_root,dim=0).cpu().numpy(), torch.ones(1,num_notes))
         else:
@@ -358,37 +410,34 @@ class ArcPredictionLightModel(LightningModule):
         # temp_head_seq[temp_head_seq == -1] =0
         # assert is_rest.cpu()[temp_head_seq].all() == False
         # structure the postprocess results in an adjency matrix with edges that point toward the child node. Also predict the list of d_arcs
+        head_seq_t = torch.from_numpy(head_seq).to(self.device).long()
+        idx = torch.arange(len(head_seq_t), device=self.device)
+        # the first element and the rests are not arcs, they are attached to 0 in the adj matrix (the (0,0) self loop for the first element)
+        is_arc = (head_seq_t >= 0) & (idx != 0)
         adj_pred_postp = torch.zeros((num_notes+1,num_notes+1), device=self.device)
-        pred_arc_postp = []
-        for i, head in enumerate(head_seq):
-            if i== 0: # we add the self loop (0,0) to adj matrix, but not to the list of arcs
-                adj_pred_postp[0, 0] = 1
-            elif head < 0: # rest element, we don't add it to the arcs, only to the matrix
-                adj_pred_postp[0, i] = 1
-            elif head != 0:
-                # id is index in note list + 1
-                adj_pred_postp[head, i] = 1
-                pred_arc_postp.append([head, i])
-                assert not is_rest.cpu()[head]
-            else: #handle the root. Same as before
-                root = i
-                adj_pred_postp[head, i] = 1
-                pred_arc_postp.append([head, i])
-        return adj_pred_postp, torch.tensor(pred_arc_postp, device = self.device), torch.tensor(np.insert(head_seq[1:],0,0))
+        adj_pred_postp[torch.where(is_arc, head_seq_t, torch.zeros_like(head_seq_t)), idx] = 1
+        pred_arc_postp = torch.stack((head_seq_t[is_arc], idx[is_arc]), dim=1)
+        return adj_pred_postp, pred_arc_postp, torch.tensor(np.insert(head_seq[1:],0,0))
+
 
+    def optimizer_kwargs(self, optimizer_class):
+        """Use the fused implementation of the optimizer when it exists and the model is on gpu, otherwise the multi-tensor (foreach) one."""
+        if self.device.type == "cuda" and "fused" in inspect.signature(optimizer_class).parameters:
+            return {"fused": True}
+        return {"foreach": True}
 
     def configure_optimizers(self):
         if self.optimizer == "adamw":
-            optimizer = torch.optim.AdamW(self.parameters(), lr=self.lr, weight_decay=self.weight_decay)
+            optimizer = torch.optim.AdamW(self.parameters(), lr=self.lr, weight_decay=self.weight_decay, **self.optimizer_kwargs(torch.optim.AdamW))
             self.lr_scheduler = None
         elif self.optimizer == "radam":
-            optimizer = torch.optim.RAdam(self.parameters(), lr=self.lr, weight_decay=self.weight_decay)
+            optimizer = torch.optim.RAdam(self.parameters(), lr=self.lr, weight_decay=self.weight_decay, **self.optimizer_kwargs(torch.optim.RAdam))
             self.lr_scheduler = None
         elif self.optimizer == "warmadamw":
-            optimizer = torch.optim.AdamW(self.parameters(), lr=self.lr, weight_decay=self.weight_decay)
+            optimizer = torch.optim.AdamW(self.parameters(), lr=self.lr, weight_decay=self.weight_decay, **self.optimizer_kwargs(torch.optim.AdamW))
             self.lr_scheduler = CosineWarmupScheduler(optimizer, self.warmup_steps, self.max_epochs*self.len_train_dataloader)
         elif self.optimizer == "warmadam":
-            optimizer = torch.optim.Adam(self.parameters(), lr=self.lr, weight_decay=self.weight_decay)
+            optimizer = torch.optim.Adam(self.parameters(), lr=self.lr, weight_decay=self.weight_decay, **self.optimizer_kwargs(torch.optim.Adam))
             self.lr_scheduler = CosineWarmupScheduler(optimizer, self.warmup_steps, self.max_epochs*self.len_train_dataloader)
         else:
             raise ValueError("optimizer must be either warmadamw, or warmadam")
@@ -396,24 +445,24 @@ class ArcPredictionLightModel(LightningModule):
             "optimizer": optimizer,
         }
     
+    def optimizer_zero_grad(self, epoch, batch_idx, optimizer, optimizer_idx):
+        # free the gradients instead of filling them with zeros (not the default in torch<2.0)
+        optimizer.zero_grad(set_to_none=True)
+
     def optimizer_step(self, *args, **kwargs):
         super().optimizer_step(*args, **kwargs)
         if self.lr_scheduler is not None:
             self.lr_scheduler.step()  # Step per iteration, we need to do it here, not to return the scheduler to the pytorch lightning trainer
 
 def reintroduce_rests(head_seq, is_rest):
-    rest_indices = np.where(is_rest)[0]
-    new_head_seq = np.zeros_like(is_rest) -1
-    new_idx = 0
+    # position of each non-rest element in the sequence with rests
+    non_rest_indices = np.where(~is_rest)[0]
+    new_head_seq = np.full(is_rest.shape, -1, dtype=np.int64)
     # insert the rests in the head_seq
-    for i,r in enumerate(is_rest):
-        if not r: # not rest
-            new_head_seq[i] = head_seq[new_idx]
-            new_idx += 1
+    new_head_seq[~is_rest] = head_seq
     # update indices of the heads according to rests
-    for i in rest_indices:
-            # add 1 to the heads that are after the rest
-            new_head_seq[new_head_seq>=i] += 1
+    has_head = new_head_seq >= 0
+    new_head_seq[has_head] = non_rest_indices[new_head_seq[has_head]]
     return new_head_seq
 
 
@@ -457,7 +506,8 @@ class TransformerEncoder(torch.nn.Module):
             d_model=input_dim, dropout=dropout, max_len=200
         )
         if not rpr: # normal transformer with absolute positional representation
-            encoder_layer = nn.TransformerEncoderLayer(d_model=input_dim, dim_feedforward=hidden_dim, nhead=n_heads, dropout =dropout, activation=activation)
+            # batch_first lets pytorch dispatch to its fused attention fast path
+            encoder_layer = nn.TransformerEncoderLayer(d_model=input_dim, dim_feedforward=hidden_dim, nhead=n_heads, dropout =dropout, activation=activation, batch_first=True)
             encoder_norm = nn.LayerNorm(input_dim)
             self.transformer_encoder = nn.TransformerEncoder(encoder_layer, num_layers=encoder_depth, norm=encoder_norm)
         else: # relative positional representation
@@ -466,14 +516,15 @@ class TransformerEncoder(torch.nn.Module):
             self.transformer_encoder = TransformerEncoderRPR(encoder_layer, encoder_depth, encoder_norm)
 
     def forward(self, z, src_mask=None):
-        # add positional encoding
-        z = self.positional_encoder(z)
-        # reshape to (seq_len, batch = 1, input_dim)
-        z = torch.unsqueeze(z,dim= 1)
+        # add positional encoding (in place, z is the freshly computed output of the embeddings)
+        z = self.positional_encoder(z.contiguous())
+        # reshape to (batch = 1, seq_len, input_dim), or (seq_len, batch = 1, input_dim) for the rpr encoder
+        batch_dim = 1 if self.rpr else 0
+        z = torch.unsqueeze(z,dim= batch_dim)
         # run transformer encoder
         z = self.transformer_encoder(src=z, mask=src_mask)
         # remove batch dim
-        z = torch.squeeze(z, dim=1)
+        z = torch.squeeze(z, dim=batch_dim)
         return z, ""
 
 
@@ -488,14 +539,16 @@ class PositionalEncoding(nn.Module):
         pe = torch.zeros(max_len, d_model)
         pe[:, 0::2] = torch.sin(position * div_term)
         pe[:, 1::2] = torch.cos(position * div_term)
-        self.register_buffer('pe', pe)
+        # the encoding is recomputed at init, no need to store it in the checkpoints
+        self.register_buffer('pe', pe, persistent=False)
 
     def forward(self, x: torch.Tensor) -> torch.Tensor:
         """
         Args:
             x: Tensor, shape [seq_len, batch_size, embedding_dim]
         """
-        x = x + self.pe[:x.size(0)]
+        # in place, x is always a freshly allocated tensor (see TransformerEncoder.forward)
+        x.add_(self.pe[:x.size(0)].to(dtype=x.dtype))
         return self.dropout(x)
 
 class NotesEncoder(torch.nn.Module):
@@ -551,76 +604,76 @@ class NotesEncoder(torch.nn.Module):
         if use_embeddings:
             if data_type == "notes":
                 if not "sum" in embedding_dim.keys():
-                    self.embeddings = nn.ModuleDict({
-                        "pitch": nn.Embedding(NUMBER_OF_PITCHES, embedding_dim["pitch"]),
-                        "duration": nn.Embedding(len(DURATIONS), embedding_dim["duration"]),
-                        "metrical": nn.Embedding(METRICAL_LEVELS, embedding_dim["metrical"])
-                    })
+                    # embedding tables as plain parameters, looked up with F.embedding
+                    self.pitch_w = embedding_weight(NUMBER_OF_PITCHES, embedding_dim["pitch"])
+                    self.duration_w = embedding_weight(len(DURATIONS), embedding_dim["duration"])
+                    self.metrical_w = embedding_weight(METRICAL_LEVELS, embedding_dim["metrical"])
                 else:
-                    self.embeddings = nn.ModuleDict({
-                        "pitch": nn.Embedding(NUMBER_OF_PITCHES, embedding_dim["sum"]),
-                        "duration": nn.Embedding(len(DURATIONS), embedding_dim["sum"]),
-                        "metrical": nn.Embedding(METRICAL_LEVELS, embedding_dim["sum"])
-                    })
+                    # pitch, duration, metrical (columns 0, 2, 3) are summed with a single lookup in a shared table
+                    self.init_summed_embeddings([NUMBER_OF_PITCHES, len(DURATIONS), METRICAL_LEVELS], [0, 2, 3], embedding_dim["sum"])
 
             elif data_type == "chords":
                 # root_numbers, chord_forms, chord_extensions, duration_indices, metrical_indices
                 if not "sum" in embedding_dim.keys():
-                    self.embeddings = nn.ModuleDict({
-                        "root": nn.Embedding(12, embedding_dim["root"]),
-                        "form": nn.Embedding(len(CHORD_FORM), embedding_dim["form"]),
-                        "ext": nn.Embedding(len(CHORD_EXTENSION), embedding_dim["ext"]),
-                        "duration": nn.Embedding(len(JTB_DURATION), embedding_dim["duration"]),
-                        "metrical": nn.Embedding(METRICAL_LEVELS, embedding_dim["metrical"])
-                    })
+                    # embedding tables as plain parameters, looked up with F.embedding
+                    self.root_w = embedding_weight(12, embedding_dim["root"])
+                    self.form_w = embedding_weight(len(CHORD_FORM), embedding_dim["form"])
+                    self.ext_w = embedding_weight(len(CHORD_EXTENSION), embedding_dim["ext"])
+                    self.duration_w = embedding_weight(len(JTB_DURATION), embedding_dim["duration"])
+                    self.metrical_w = embedding_weight(METRICAL_LEVELS, embedding_dim["metrical"])
                 else:
-                    self.embeddings = nn.ModuleDict({
-                        "root": nn.Embedding(12, embedding_dim["sum"]),
-                        "form": nn.Embedding(len(CHORD_FORM), embedding_dim["sum"]),
-                        "ext": nn.Embedding(len(CHORD_EXTENSION), embedding_dim["sum"]),
-                        "duration": nn.Embedding(len(JTB_DURATION), embedding_dim["sum"]),
-                        "metrical": nn.Embedding(METRICAL_LEVELS, embedding_dim["sum"])
-                    })
+                    # root, form, ext, duration, metrical are summed with a single lookup in a shared table
+                    self.init_summed_embeddings([12, len(CHORD_FORM), len(CHORD_EXTENSION), len(JTB_DURATION), METRICAL_LEVELS], [0, 1, 2, 3, 4], embedding_dim["sum"])
             else:
                 raise ValueError(f"Data type {data_type} not supported")
+        # choose the embedding function once, instead of branching on the data type at every forward
+        if not use_embeddings:
+            self.embed = get_feats_one_hot
+        elif "sum" in embedding_dim.keys():
+            self.embed = self.embed_summed
+        elif data_type == "notes":
+            self.embed = self.embed_notes
+        else:
+            self.embed = self.embed_chords
+
+    def init_summed_embeddings(self, vocab_sizes, columns, dim):
+        """Single EmbeddingBag over the concatenated vocabularies of all features, the indices of each feature are shifted by an offset."""
+        self.embeddings = nn.EmbeddingBag(pad_to_multiple(sum(vocab_sizes)), dim, mode="sum")
+        self.register_buffer("embedding_offsets", torch.tensor(np.cumsum([0] + vocab_sizes[:-1])), persistent=False)
+        self.register_buffer("embedding_columns", torch.tensor(columns), persistent=False)
+
+    def embed_summed(self, sequence):
+        # one fused gather and sum over the features, each row of indices is a bag
+        return self.embeddings(sequence[:, self.embedding_columns].long() + self.embedding_offsets)
+
+    def embed_notes(self, sequence):
+        # we are discarding rests information at [:,1] because it is in the pitch
+        pitch = sequence[:,0]
+        duration = sequence[:,2]
+        metrical = sequence[:,3]
+        pitch = F.embedding(pitch.long(), self.pitch_w)
+        duration = F.embedding(duration.long(), self.duration_w)
+        metrical = F.embedding(metrical.long(), self.metrical_w)
+        # concatenate embeddings
+        return torch.cat((pitch, duration, metrical), dim=1)
+
+    def embed_chords(self, sequence):
+        root = sequence[:,0]
+        form = sequence[:,1]
+        ext = sequence[:,2]
+        duration = sequence[:,3]
+        metrical = sequence[:,4]
+        root = F.embedding(root.long(), self.root_w)
+        form = F.embedding(form.long(), self.form_w)
+        ext = F.embedding(ext.long(), self.ext_w)
+        duration = F.embedding(duration.long(), self.duration_w)
+        metrical = F.embedding(metrical.long(), self.metrical_w)
+        # concatenate embeddings
+        return torch.cat((root, form, ext, duration, metrical), dim=1)
 
     def forward(self, sequence, mask=None):
-        if self.use_embeddings:
-            # run embedding
-            if self.data_type == "notes":
-                # we are discarding rests information at [:,1] because it is in the pitch
-                pitch = sequence[:,0]
-                duration = sequence[:,2]
-                metrical = sequence[:,3]
-                pitch = self.embeddings["pitch"](pitch.long())
-                duration = self.embeddings["duration"](duration.long())
-                metrical = self.embeddings["metrical"](metrical.long())
-                if not "sum" in self.embedding_dim.keys():
-                    # concatenate embeddings
-                    z = torch.hstack((pitch, duration, metrical))
-                else:
-                    # sum all embeddings
-                    z = pitch + duration + metrical
-            elif self.data_type == "chords":
-                root = sequence[:,0]
-                form = sequence[:,1]
-                ext = sequence[:,2]
-                duration = sequence[:,3]
-                metrical = sequence[:,4]
-                root = self.embeddings["root"](root.long())
-                form = self.embeddings["form"](form.long())
-                ext = self.embeddings["ext"](ext.long())
-                duration = self.embeddings["duration"](duration.long())
-                metrical = self.embeddings["metrical"](metrical.long())
-                if not "sum" in self.embedding_dim.keys():
-                    # concatenate embeddings
-                    z = torch.hstack((root, form, ext, duration, metrical))
-                else:
-                    # sum all embeddings
-                    z = root + form + ext + duration + metrical
-        else:
-            # one hot encoding
-            z = get_feats_one_hot(sequence)
+        # run embedding (or one hot encoding), the variant is chosen at init
+        z = self.embed(sequence)
 
         if mask is None:
             z, _ = self.encoder_cell(z)
@@ -641,18 +694,20 @@ class ArcDecoder(torch.nn.Module):
         self.root_linear = nn.Linear(1, hidden_channels) # linear to produce root features
         if not pretrain_mode: # normal functioning, predicting arcs
             if biaffine:
-                self.lin1 = nn.Linear(hidden_channels, hidden_channels)
-                self.lin2 = nn.Linear(hidden_channels, hidden_channels)
-                self.bilinear = nn.Bilinear(hidden_channels , hidden_channels, 1)
+                # the projections of the starting and ending nodes are stacked in a single linear layer (first and second half of the output)
+                self.lin12 = nn.Linear(hidden_channels, 2*hidden_channels)
+                # bilinear layer with a single output, same initialization as nn.Bilinear(hidden_channels, hidden_channels, 1)
+                bound = 1 / np.sqrt(hidden_channels)
+                self.bilinear_weight = nn.Parameter(torch.empty(hidden_channels, hidden_channels).uniform_(-bound, bound))
+                self.bilinear_bias = nn.Parameter(torch.empty(1).uniform_(-bound, bound))
             else:
                 self.lin1 = nn.Linear(2*hidden_channels, hidden_channels)
                 self.lin2 = nn.Linear(hidden_channels, 1)
         else: # pretraining mode, predicting chords
-            self.lin_root = nn.Linear(hidden_channels, 12)
-            self.lin_form = nn.Linear(hidden_channels, len(CHORD_FORM))
-            self.lin_ext = nn.Linear(hidden_channels, len(CHORD_EXTENSION))
-            self.lin_duration = nn.Linear(hidden_channels, len(JTB_DURATION))
-            self.lin_metrical = nn.Linear(hidden_channels, METRICAL_LEVELS)
+            # the root, form, ext, duration, metrical heads are stacked in a single linear layer, and split in forward.
+            # Each block has the same initialization as a separate nn.Linear, since they all have the same fan in
+            self.chord_splits = [12, len(CHORD_FORM), len(CHORD_EXTENSION), len(JTB_DURATION), METRICAL_LEVELS]
+            self.lin_chord = nn.Linear(hidden_channels, sum(self.chord_splits))
         self.dropout = nn.Dropout(dropout)
         self.norm = nn.LayerNorm(hidden_channels)
         
@@ -660,34 +715,41 @@ class ArcDecoder(torch.nn.Module):
     def forward(self, z, pot_arcs):
         # add column for the root element
         # z = torch.cat((torch.ones((1,z.shape[1]),device=z.device),z), dim = 0)
-        root_feat = self.root_linear(torch.ones((1,1), device=z.device))
-        z = torch.vstack((root_feat,z))
+        # same as self.root_linear(torch.ones((1,1))), without allocating the constant input at every forward
+        root_feat = (self.root_linear.weight.T + self.root_linear.bias).to(z.dtype)
+        z = torch.cat((root_feat,z), dim=0)
         # proceed with the computation
         z = self.norm(z)
         if not self.pretrain_mode: # normal functioning, predicting arcs
+            # indices of the starting and ending nodes, contiguous for index_select
+            src, dst = pot_arcs.T.contiguous()
+            # the linear layers, activations and norms act on each node independently, so they are computed on the
+            # num_notes+1 nodes before gathering the num_pot_arcs pairs. Dropout is applied after the gather, independently for each pair
             if self.biaffine:
+                # pass through the stacked linear layer, shape (num_notes+1, 2, hidden_channels)
+                z = self.lin12(z).view(z.shape[0], 2, -1)
+                # pass through an activation function
+                z = self.activation(z)
+                # normalize, each of the two projections separately
+                z = self.norm(z)
+                input1 = z[:, 0]
+                input2 = z[:, 1]
                 # get the embeddings of the starting and ending nodes, both of shape (num_pot_arcs, hidden_channels)
-                input1 =  z[pot_arcs[:, 0]]
-                input2 = z[pot_arcs[:, 1]]
-                # pass through a linear layer, shape (num_pot_arcs, hidden_channels)
-                input1 = self.lin1(input1)
-                input2 = self.lin2(input2)
-                # pass through an activation function, shape (num_pot_arcs, hidden_channels)
-                input1 = self.activation(input1)
-                input2 = self.activation(input2)
-                # normalize
-                input1 = self.norm(input1)
-                input2 = self.norm(input2)
+                input1 = torch.index_select(input1, 0, src)
+                input2 = torch.index_select(input2, 0, dst)
                 # pass through a dropout layer, shape (num_pot_arcs, hidden_channels)
                 input1 = self.dropout(input1)
                 input2 = self.dropout(input2)
-                # pass through the bilinear layer
-                z = self.bilinear(input1, input2)
+                # pass through the bilinear layer, as a single matmul followed by a rowwise dot product, shape (num_pot_arcs,)
+                z = ((input1 @ self.bilinear_weight) * input2).sum(dim=-1) + self.bilinear_bias
             else:
-                # concat the embeddings of the two nodes, shape (num_pot_arcs, 2*hidden_channels)
-                z = torch.cat([z[pot_arcs[:, 0]], z[pot_arcs[:, 1]]], dim=-1)
-                # pass through a linear layer, shape (num_pot_arcs, hidden_channels)
-                z = self.lin1(z)
+                # the linear layer on the concatenation of the two nodes is the sum of the two halves of the weight applied to each node,
+                # shape (num_notes+1, hidden_channels)
+                hidden_channels = z.shape[1]
+                z_src = F.linear(z, self.lin1.weight[:, :hidden_channels])
+                z_dst = F.linear(z, self.lin1.weight[:, hidden_channels:], self.lin1.bias)
+                # sum the projections of the starting and ending nodes, shape (num_pot_arcs, hidden_channels)
+                z = torch.index_select(z_src, 0, src) + torch.index_select(z_dst, 0, dst)
                 # pass through activation, shape (num_pot_arcs, hidden_channels)
                 z = self.activation(z)
                 # normalize
@@ -699,13 +761,8 @@ class ArcDecoder(torch.nn.Module):
             # return a vector of shape (num_pot_arcs,)
             return z.view(-1)
         else: # pretraining mode, predicting chords
-            out = {}
-            out["root"] = self.lin_root(z)
-            out["form"] = self.lin_form(z)
-            out["ext"] = self.lin_ext(z)
-            out["dur"] = self.lin_duration(z)
-            out["met"] = self.lin_metrical(z)
-            return out
+            # tuple of logits in the order of the chord features: root, form, ext, dur, met
+            return self.lin_chord(z).split(self.chord_splits, dim=-1)
 
 
 class ArcPredictionModel(nn.Module):
@@ -734,9 +791,18 @@ class ArcPredictionModel(nn.Module):
         return self.decoder(z, pot_arcs)
 
 
-def generate_square_subsequent_mask(sz: int) -> torch.Tensor:
-    """Generates an upper-triangular matrix of -inf, with zeros on diag."""
-    return torch.triu(torch.ones(sz, sz) * float('-inf'), diagonal=1)
+@lru_cache(maxsize=32)
+def generate_square_subsequent_mask(sz: int, device="cpu", dtype=torch.float32) -> torch.Tensor:
+    """Generates an upper-triangular matrix of -inf, with zeros on diag, directly on the device.
+    Cached by size, since the same sequence lengths come back every epoch. The returned mask must not be modified in place."""
+    return torch.triu(torch.full((sz, sz), float('-inf'), device=device, dtype=dtype), diagonal=1)
+
 
+def pad_to_multiple(n: int, multiple: int = 8) -> int:
+    """Round n up to the next multiple, used to have aligned embedding tables. The extra rows are never indexed."""
+    return (n + multiple - 1) // multiple * multiple
 
 
+def embedding_weight(num_embeddings: int, embedding_dim: int) -> nn.Parameter:
+    """Embedding table with the number of rows padded to a multiple of 8, initialized like nn.Embedding."""
+    return nn.Parameter(torch.empty(pad_to_multiple(num_embeddings), embedding_dim).normal_())
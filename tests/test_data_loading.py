@@ -1,11 +1,13 @@
 import pytest
 import numpy as np
 import pandas as pd
+import torch
 from pathlib import Path
 
 from musicparser.data_loading import get_metrical_strength
 from musicparser.data_loading import get_note_features_and_dep_arcs
-from musicparser.models import reintroduce_rests
+from musicparser.data_loading import collate_sequences, BucketBatchSampler, get_dataloader
+from musicparser.models import reintroduce_rests, ArcPredictionLightModel
 
 
 def test_metrical_strength_68():
@@ -70,4 +72,77 @@ def test_reintroduce_rests():
     
     for i, head in enumerate(head_rest):
         if head > 0:
-            assert not is_rest[head]
\ No newline at end of file
+            assert not is_rest[head]
+
+
+def _dummy_piece(num_notes):
+    note_seq = torch.arange(num_notes * 4).reshape(num_notes, 4) + 1
+    pot_arcs = torch.cartesian_prod(torch.arange(num_notes + 1), torch.arange(1, num_notes + 1))
+    truth_mask = torch.ones(len(pot_arcs), dtype=torch.bool)
+    head_seq = torch.arange(num_notes + 1)
+    return note_seq, truth_mask, pot_arcs.flatten(), head_seq
+
+
+def test_collate_sequences():
+    pieces = [_dummy_piece(3), _dummy_piece(5)]
+    note_seqs, truth_masks, pot_arcs, head_seqs, is_rest, lengths = collate_sequences(pieces)
+    assert note_seqs.shape == (2, 5, 4)
+    assert torch.all(note_seqs[0, 3:] == 0)
+    assert truth_masks.shape == (2, 30)
+    assert not torch.any(truth_masks[0, 12:])
+    # the flat potential arcs are reshaped to pairs
+    assert pot_arcs.shape == (2, 30, 2)
+    assert torch.equal(pot_arcs[0, :12], pieces[0][2].reshape(-1, 2))
+    assert torch.all(head_seqs[0, 4:] == -1)
+    assert torch.equal(is_rest, head_seqs == -1)
+    assert lengths.tolist() == [[3, 12], [5, 30]]
+    # chords have no rests, so the head padding is not marked
+    *_, is_rest, _ = collate_sequences(pieces, has_rests=False)
+    assert not torch.any(is_rest)
+
+
+def test_bucket_batch_sampler():
+    lengths = [7, 3, 9, 3, 5, 12, 1, 8, 4, 6, 2]
+    sampler = BucketBatchSampler(lengths, batch_size=4)
+    batches = list(sampler)
+    assert len(batches) == len(sampler) == 3
+    assert sorted(len(b) for b in batches) == [3, 4, 4]
+    assert sorted(i for b in batches for i in b) == list(range(len(lengths)))
+    # similar lengths are batched together
+    assert sorted(sorted(lengths[i] for i in b) for b in batches) == [[1, 2, 3, 3], [4, 5, 6, 7], [8, 9, 12]]
+
+
+def test_bucket_batch_sampler_distributed():
+    lengths = list(range(11))
+    samplers = [BucketBatchSampler(lengths, batch_size=2, num_replicas=2, rank=rank) for rank in range(2)]
+    for epoch in range(3):
+        for sampler in samplers:
+            sampler.set_epoch(epoch)
+        batches = [list(sampler) for sampler in samplers]
+        # every replica runs the same number of steps, and all the pieces are seen
+        assert len(batches[0]) == len(batches[1]) == len(samplers[0]) == 3
+        assert set(i for rank_batches in batches for b in rank_batches for i in b) == set(range(len(lengths)))
+
+
+def test_unbatch_round_trip():
+    pieces = [_dummy_piece(3), _dummy_piece(5), _dummy_piece(1)]
+    model = ArcPredictionLightModel(25, 8)
+    unbatched = model.unbatch(collate_sequences(pieces))
+    assert len(unbatched) == len(pieces)
+    for (note_seq, truth_mask, pot_arcs, head_seq), (u_note_seq, u_truth_mask, u_pot_arcs, u_head_seq, u_is_rest) in zip(pieces, unbatched):
+        assert torch.equal(u_note_seq, note_seq)
+        assert torch.equal(u_truth_mask, truth_mask)
+        assert torch.equal(u_pot_arcs, pot_arcs.reshape(-1, 2))
+        assert torch.equal(u_head_seq, head_seq)
+        assert not torch.any(u_is_rest)
+
+
+def test_dataloader_workers_many_tensors():
+    # 400 tensors, more than can be sent to a worker with one file descriptor each
+    pieces = [_dummy_piece(n % 7 + 1) for n in range(100)]
+    dataloader = get_dataloader(pieces, batch_size=1, num_workers=2)
+    num_pieces = 0
+    for note_seqs, truth_masks, pot_arcs, head_seqs, is_rest, lengths in dataloader:
+        assert torch.equal(note_seqs[0], pieces[num_pieces][0])
+        num_pieces += 1
+    assert num_pieces == len(pieces)
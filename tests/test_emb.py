@@ -0,0 +1,29 @@
+import ast
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "launch_scripts"))
+from _emb import build_embedding_config
+
+
+def test_embedding_config_concat():
+    embedding_dim, emb_str, use_embeddings = build_embedding_config(ast.literal_eval("[12,4,6,8,2]"))
+    assert embedding_dim == {"root": 12, "form": 4, "ext": 6, "duration": 8, "metrical": 2}
+    assert emb_str == "r12f4e6d8m2"
+    assert use_embeddings
+
+
+def test_embedding_config_sum():
+    for emb_arg in ["[96]", "96"]:
+        embedding_dim, emb_str, use_embeddings = build_embedding_config(ast.literal_eval(emb_arg))
+        assert embedding_dim == {"sum": 96}
+        assert emb_str == "sum96"
+        assert use_embeddings
+
+
+def test_embedding_config_no_embeddings():
+    for emb_arg in ["[]", "0"]:
+        embedding_dim, emb_str, use_embeddings = build_embedding_config(ast.literal_eval(emb_arg))
+        assert embedding_dim == {}
+        assert emb_str == "noEmb"
+        assert not use_embeddings